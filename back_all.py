@@ -2,14 +2,22 @@ import os
 import uuid
 import pandas as pd
 import requests
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_file, abort
 from flask_cors import CORS
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from werkzeug.security import safe_join
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import time
 import traceback
 import io
 import json
 import logging
+import hashlib
+import threading
+import shutil
+import sqlite3
+import re
+import math
+from contextlib import contextmanager
 
 # =============================================================================
 # 🎯 可配置参数区域 - 所有重要参数集中在这里
@@ -18,14 +26,19 @@ import logging
 # --- Flask 服务配置 ---
 FLASK_HOST = '0.0.0.0'                    # Flask服务监听地址
 FLASK_PORT = 8520                          # Flask服务端口
-FLASK_DEBUG = True                         # 是否启用调试模式
+FLASK_DEBUG = True                         # 是否启用调试模式（仅 dev 模式生效）
+
+# --- 运行模式配置 ---
+RUN_MODE = os.environ.get('RUN_MODE', 'dev')   # 'dev': Flask开发服务器单进程; 'production': gunicorn 多进程
+PRODUCTION_WORKERS = 4                     # 生产模式下的工作进程数
+PRODUCTION_THREADS = 8                     # 每个工作进程的线程数（gthread）
+PRODUCTION_TIMEOUT = 3600                  # 生产模式请求超时（秒），大文件任务是同步处理的，需要足够长
 
 # --- 文件URL配置 ---
 FILE_SERVER_HOST = '192.168.131.59'     # 文件服务器地址
 FILE_SERVER_PORT = '8520'                # 文件服务器端口
 
 # --- 文件路径配置 ---
-UPLOAD_FOLDER = 'temp'                     # 上传文件临时存储目录
 DOWNLOAD_FOLDER = os.path.join('static', 'downloads')  # 下载文件存储目录
 ALLOWED_EXTENSIONS = {'xlsx', 'xls'}     # 允许的文件扩展名
 
@@ -34,6 +47,19 @@ DIFY_API_BASE_URL = 'http://192.168.125.223/v1'      # Dify API基础URL
 DIFY_API_KEY = 'Bearer app-6h0jlXree8oBQ10Yyjyk3eCk'  # Dify API认证密钥
 DIFY_INPUT_VARIABLE_NAME = 'uploaded_file'             # 工作流输入变量名
 DIFY_OUTPUT_VARIABLE_NAME = 'download_link'            # 工作流输出变量名
+DIFY_WORKFLOW_USER = 'backend_service_user'            # 调用工作流时的用户标识（停止任务时必须一致）
+
+# --- Dify 后端池配置（chunk 工作流调用在这些后端之间负载均衡）---
+# 每个后端: base_url / api_key / weight(权重) / max_concurrency(本进程内的并发上限)
+# 注意: 并发上限按进程计算，生产模式下该后端实际最多有 max_concurrency x PRODUCTION_WORKERS 个在途请求；
+# 摘除状态则通过共享状态库在所有工作进程之间同步
+DIFY_BACKENDS = [
+    {'base_url': DIFY_API_BASE_URL, 'api_key': DIFY_API_KEY, 'weight': 1, 'max_concurrency': 6},
+]
+DIFY_BALANCE_STRATEGY = 'least_outstanding'  # 'least_outstanding': 按 在途请求数/权重 选最小; 'weighted': 平滑加权轮询
+BACKEND_EJECT_AFTER_ERRORS = 3            # 连续失败多少次后暂时摘除后端
+BACKEND_EJECT_SECONDS = 30                # 摘除时长（秒），到期后重新接入试探
+BACKEND_ACQUIRE_POLL_SECONDS = 1          # 所有后端都满载或被摘除时的等待轮询间隔（秒）
 
 # --- 工作流处理配置 ---
 DEFAULT_CHUNK_SIZE = 30                   # 默认每个chunk的行数（增加chunk大小减少任务数量）
@@ -43,6 +69,44 @@ RETRY_DELAY = 1                           # 重试间隔时间（秒）
 REQUEST_TIMEOUT = 180                     # 请求超时时间（秒）
 FILE_DOWNLOAD_TIMEOUT = 60              # 文件下载超时时间（秒）
 
+# --- 对冲请求配置（慢chunk超过本任务的耗时分位数后再发一个副本，取先完成者）---
+ENABLE_HEDGING = False                    # 是否默认启用对冲请求（请求中可用 hedging=true/false 覆盖）
+HEDGE_PERCENTILE = 0.95                   # 超过本任务已完成chunk耗时的该分位数时发出对冲请求
+HEDGE_MIN_SAMPLES = 5                     # 已完成chunk数少于该值时不对冲（分位数不可靠）
+HEDGE_BUDGET_RATIO = 0.05                 # 每个任务最多额外发出 总chunk数 x 该比例 个对冲请求
+HEDGE_MIN_BUDGET = 1                      # 每个任务至少允许的对冲请求数
+HEDGE_POLL_SECONDS = 1                    # 检查是否需要对冲的间隔（秒）
+TASK_STOP_TIMEOUT = 10                    # 停止被取消的Dify工作流任务的请求超时（秒）
+
+# --- 本地预筛选配置（在调用Dify之前用关键词/正则排除明显无关的行）---
+ENABLE_PREFILTER = False                  # 是否默认启用预筛选（请求中可用 prefilter=true/false 覆盖）
+PREFILTER_COLUMNS = ['项目名称', '标题', '项目概况']  # 参与匹配的列，不存在的列会被忽略；为空时使用全部文本列
+PREFILTER_USE_REGEX = True                 # True: 规则按正则表达式匹配; False: 按普通子串匹配
+# 按 which_aspects 取值配置规则，include 任一命中才保留，exclude 任一命中即排除；未配置的 aspect 不做预筛选
+PREFILTER_RULES = {
+    '水质、水务、水利的招标信息数据': {
+        'include': ['水', '给排水', '管网', '泵站', '河道', '河湖', '堤防', '灌溉', '防洪', '排涝'],
+        'exclude': ['家具', '办公用品', '被服'],
+    },
+}
+
+# --- 行去重配置（发送前按分类相关列合并重复项目，结果再分发回每个重复行）---
+ENABLE_ROW_DEDUP = False                  # 是否默认启用行去重（请求中可用 dedup=true/false 覆盖）
+DEDUP_COLUMNS = ['项目名称', '标题', '项目概况']  # 用于判断重复的列，不存在的列会被忽略
+DEDUP_IGNORE_COLUMNS = ['关键词', '时间']   # DEDUP_COLUMNS 都不存在时，除这些列和ID列外的全部列参与判断
+
+# --- 列投影配置（只把分类需要的列和id发送给Dify，减少文件大小和token）---
+ENABLE_COLUMN_PROJECTION = False          # 是否默认启用列投影（请求中可用 projection=true/false 覆盖）
+PROJECTION_COLUMNS = ['项目名称', '标题', '项目概况']  # 默认发送的列（id列总会保留），不存在的列会被忽略
+PROJECTION_COLUMNS_BY_ASPECT = {          # 按 which_aspects 覆盖发送的列
+    # '水质、水务、水利的招标信息数据': ['项目名称', '项目概况'],
+}
+
+# --- 多方面批量分类配置（一个任务同时按多个 which_aspects 分类，chunk只切分和上传一次）---
+MAX_ASPECTS_PER_JOB = 10                  # 单个任务最多的 which_aspects 数量
+ENABLE_ASPECT_SHEETS = True               # 多方面任务是否在最终Excel中为每个方面单独生成工作表（请求中可用 aspect_sheets 覆盖）
+ALL_ASPECTS_SHEET_NAME = '全部结果'        # 多方面任务中汇总工作表的名称
+
 # --- 列名配置 ---
 ID_COLUMN_NAME = 'id'                      # 默认ID列名
 POSSIBLE_ID_COLUMNS = ['id', 'ID', '编号', '序号']  # 可能的ID列名列表
@@ -59,6 +123,23 @@ ENABLE_TRACEBACK_PRINT = True              # 是否打印错误堆栈信息
 GENERATE_UNIQUE_FILENAMES = True          # 是否生成唯一文件名（防止冲突）
 UUID_LENGTH = 8                            # 唯一文件名中UUID的长度
 
+# --- 共享状态配置（多进程共享的任务注册表和产物索引）---
+STATE_FOLDER = 'state'                     # 共享状态目录（不要放在 static 下，避免被直接下载）
+STATE_DB_PATH = os.path.join(STATE_FOLDER, 'jobs.db')  # SQLite 数据库路径，所有工作进程必须指向同一个文件
+JOB_CHECKPOINT_FOLDER = os.path.join(STATE_FOLDER, 'jobs')  # 每个任务的输入文件和chunk计划，任务结束后删除
+RESUME_INTERRUPTED_JOBS = True             # 启动时是否自动恢复被中断（进程重启/崩溃）的任务
+MAX_RESUME_ATTEMPTS = 3                    # 单个任务最多恢复次数，超过后标记为失败（避免反复导致进程崩溃的任务无限重启）
+SQLITE_BUSY_TIMEOUT = 30                   # SQLite 等待写锁的超时时间（秒）
+
+# --- 产物存储配置（static/downloads 下的 chunk 文件和最终结果文件）---
+ARTIFACT_HASH_LENGTH = 16                  # 内容哈希文件名中哈希的长度
+ARTIFACT_TTL_SECONDS = 6 * 3600            # 产物最后一次写入/访问后保留的时间（秒）
+ARTIFACT_MAX_TOTAL_BYTES = 2 * 1024 ** 3   # 下载目录磁盘配额（字节），超出时淘汰最久未用的文件
+ARTIFACT_EVICT_INTERVAL = 300              # 两次淘汰扫描之间的最小间隔（秒）
+DOWNLOAD_CACHE_MAX_AGE = 3600              # /downloads 响应的 Cache-Control max-age（秒）
+DOWNLOAD_OFFLOAD_MODE = None               # 文件发送卸载方式: None / 'sendfile'(X-Sendfile) / 'x-accel'(Nginx)
+X_ACCEL_REDIRECT_PREFIX = '/protected-downloads/'  # Nginx internal location，指向 DOWNLOAD_FOLDER
+
 # =============================================================================
 # ⚙️ 自动生成的URL配置（通常不需要修改）
 # =============================================================================
@@ -75,10 +156,10 @@ CORS(app, origins=['http://192.168.131.59:8523', 'http://localhost:8523'],
      allow_headers=['Content-Type', 'Authorization'])
 
 # 确保必要的文件夹存在
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
 if not os.path.exists(DOWNLOAD_FOLDER):
     os.makedirs(DOWNLOAD_FOLDER)
+if not os.path.exists(JOB_CHECKPOINT_FOLDER):
+    os.makedirs(JOB_CHECKPOINT_FOLDER)
 
 # =============================================================================
 # 📋 配置信息打印
@@ -89,18 +170,772 @@ if ENABLE_DEBUG_PRINT:
     print(f"输出变量名: '{DIFY_OUTPUT_VARIABLE_NAME}'")
     print(f"API端点: {DIFY_API_BASE_URL} (本地部署)")
     print(f"认证方式: {DIFY_API_KEY[:20]}...")  # 显示认证前缀和密钥部分
+    print(f"Dify后端数: {len(DIFY_BACKENDS)} (均衡策略: {DIFY_BALANCE_STRATEGY}，并发上限按进程计算)")
     print(f"工作线程数: {MAX_WORKERS}")
     print(f"最大重试次数: {'无限重试' if MAX_RETRIES == -1 else MAX_RETRIES}")
     print(f"默认Chunk大小: {DEFAULT_CHUNK_SIZE}")
     print(f"文件服务器: {FILE_SERVER_HOST}:{FILE_SERVER_PORT}")
+    print(f"运行模式: {RUN_MODE}")
+    print(f"共享状态库: {STATE_DB_PATH}")
     print(f"====================")
 
+if DOWNLOAD_OFFLOAD_MODE == 'sendfile':
+    # 由前置的 Apache/lighttpd 等根据 X-Sendfile 头直接发送文件
+    app.use_x_sendfile = True
+
+
+# =============================================================================
+# 🗄️ 共享状态 - SQLite 任务注册表和产物索引（多个工作进程共用）
+# =============================================================================
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS job_chunks (
+    job_id TEXT NOT NULL,
+    chunk_id INTEGER NOT NULL,
+    aspect_index INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL,
+    retries INTEGER DEFAULT 0,
+    artifact TEXT,
+    verdict_ids TEXT,
+    updated_at REAL,
+    PRIMARY KEY (job_id, chunk_id, aspect_index)
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    which_aspects TEXT,
+    total_chunks INTEGER DEFAULT 0,
+    successful_chunks INTEGER DEFAULT 0,
+    total_retries INTEGER DEFAULT 0,
+    worker_owner TEXT,
+    resume_count INTEGER NOT NULL DEFAULT 0,
+    final_download_url TEXT,
+    error TEXT,
+    created_at REAL,
+    updated_at REAL
+);
+CREATE TABLE IF NOT EXISTS artifacts (
+    filename TEXT PRIMARY KEY,
+    last_access REAL
+);
+CREATE TABLE IF NOT EXISTS backend_health (
+    base_url TEXT PRIMARY KEY,
+    ejected_until REAL
+);
+CREATE TABLE IF NOT EXISTS artifact_refs (
+    filename TEXT NOT NULL,
+    job_id TEXT NOT NULL,
+    PRIMARY KEY (filename, job_id)
+);
+"""
+
+JOB_ID_PATTERN = re.compile(r'^[0-9A-Za-z_-]{1,64}$')
+
+
+@contextmanager
+def state_db():
+    """打开共享状态库连接，正常退出时提交。每次调用新建连接，可安全用于多线程和 fork 出的多进程"""
+    conn = sqlite3.connect(STATE_DB_PATH, timeout=SQLITE_BUSY_TIMEOUT)
+    conn.row_factory = sqlite3.Row
+    try:
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def init_state_db():
+    """建表并开启 WAL，允许多个进程并发读写"""
+    with state_db() as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(STATE_SCHEMA)
+
+
+def reserve_job(job_id):
+    """
+    原子地占用 job_id，已有存活进程在执行同一 job_id 时返回 False。
+    多个工作进程同时收到相同的 job_id 时，只有一个能占用成功。
+    """
+    now = time.time()
+    with state_db() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT status, worker_owner FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is not None and row['status'] == 'running' and is_owner_alive(row['worker_owner']):
+            return False
+        conn.execute(
+            "INSERT OR REPLACE INTO jobs (job_id, status, worker_owner, created_at, updated_at) VALUES (?, 'running', ?, ?, ?)",
+            (job_id, get_owner_token(), now, now))
+        conn.execute("DELETE FROM job_chunks WHERE job_id = ?", (job_id,))
+    return True
+
+
+def register_job(job_id, aspects, tasks):
+    """登记一个新任务及其需要调用的 (chunk_id, aspect_index)"""
+    now = time.time()
+    which_aspects = aspects[0] if len(aspects) == 1 else json.dumps(aspects, ensure_ascii=False)
+    with state_db() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO jobs (job_id, status, which_aspects, total_chunks, worker_owner, created_at, updated_at) "
+            "VALUES (?, 'running', ?, ?, ?, ?, ?)",
+            (job_id, which_aspects, len(tasks), get_owner_token(), now, now))
+        conn.execute("DELETE FROM job_chunks WHERE job_id = ?", (job_id,))
+        conn.executemany(
+            "INSERT OR REPLACE INTO job_chunks (job_id, chunk_id, aspect_index, status, retries, updated_at) "
+            "VALUES (?, ?, ?, 'pending', 0, ?)",
+            [(job_id, int(chunk_id), aspect_index, now) for chunk_id, aspect_index in tasks])
+
+
+def update_job(job_id, **fields):
+    """更新任务字段（status / final_download_url / error 等）"""
+    fields['updated_at'] = time.time()
+    assignments = ', '.join(f"{key} = ?" for key in fields)
+    with state_db() as conn:
+        conn.execute(f"UPDATE jobs SET {assignments} WHERE job_id = ?", (*fields.values(), job_id))
+
+
+def record_chunk_status(job_id, chunk_id, status=None, retries=None, artifact=None, verdict_ids=None, aspect_index=0):
+    """
+    更新单个 (chunk, aspect) 的状态，并同步任务的成功数和重试数。verdict_ids 为Dify返回的命中id，用于断点续跑。
+    chunk文件在各方面之间共用，artifact 会写到该chunk的所有方面上。
+    """
+    now = time.time()
+    task_key = (job_id, int(chunk_id), aspect_index)
+    with state_db() as conn:
+        if verdict_ids is not None:
+            conn.execute("UPDATE job_chunks SET verdict_ids = ?, updated_at = ? WHERE job_id = ? AND chunk_id = ? AND aspect_index = ?",
+                         (json.dumps(verdict_ids, default=lambda value: value.item() if hasattr(value, 'item') else str(value)),
+                          now, *task_key))
+        if status is not None:
+            conn.execute("UPDATE job_chunks SET status = ?, updated_at = ? WHERE job_id = ? AND chunk_id = ? AND aspect_index = ?",
+                         (status, now, *task_key))
+        if retries is not None:
+            conn.execute("UPDATE job_chunks SET retries = ?, updated_at = ? WHERE job_id = ? AND chunk_id = ? AND aspect_index = ?",
+                         (retries, now, *task_key))
+        if artifact is not None:
+            conn.execute("UPDATE job_chunks SET artifact = ?, updated_at = ? WHERE job_id = ? AND chunk_id = ?",
+                         (artifact, now, job_id, int(chunk_id)))
+        conn.execute(
+            "UPDATE jobs SET "
+            "successful_chunks = (SELECT COUNT(*) FROM job_chunks WHERE job_id = ? AND status = 'success'), "
+            "total_retries = (SELECT COALESCE(SUM(retries), 0) FROM job_chunks WHERE job_id = ?), "
+            "updated_at = ? WHERE job_id = ?",
+            (job_id, job_id, now, job_id))
+
+
+def get_job(job_id):
+    """读取任务及其chunk状态，任务不存在时返回 None"""
+    with state_db() as conn:
+        job = conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if job is None:
+            return None
+        chunks = conn.execute(
+            "SELECT chunk_id, aspect_index, status, retries, artifact FROM job_chunks WHERE job_id = ? ORDER BY chunk_id, aspect_index",
+            (job_id,)).fetchall()
+    job = dict(job)
+    job['chunks'] = [dict(chunk) for chunk in chunks]
+    return job
+
+
+def get_completed_chunk_verdicts(job_id):
+    """读取任务中已成功的 (chunk, aspect) 的命中id: {(chunk_id, aspect_index): [id, ...]}"""
+    with state_db() as conn:
+        rows = conn.execute(
+            "SELECT chunk_id, aspect_index, verdict_ids FROM job_chunks "
+            "WHERE job_id = ? AND status = 'success' AND verdict_ids IS NOT NULL",
+            (job_id,)).fetchall()
+    return {(row['chunk_id'], row['aspect_index']): json.loads(row['verdict_ids']) for row in rows}
+
+
+def read_boot_id():
+    """Linux 下读取本次开机的ID，读取失败返回 None"""
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+BOOT_ID = read_boot_id()
+
+
+def read_process_start_time(pid):
+    """Linux 下读取进程启动时间（开机后的时钟滴答数），读取失败返回 None"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # 第2个字段（进程名）可能含空格和括号，从最后一个 ')' 之后开始数，starttime 是第22个字段
+    return stat.rsplit(')', 1)[1].split()[19]
+
+
+def get_owner_token(pid=None):
+    """
+    任务所属进程的标识：PID + 开机ID + 进程启动时间。PID 会在容器重启后被其他进程复用，
+    仅凭 PID 无法判断原进程是否还在；无法读取 /proc 时退化为只用 PID。
+    """
+    pid = os.getpid() if pid is None else pid
+    start_time = read_process_start_time(pid)
+    if BOOT_ID is None or start_time is None:
+        return str(pid)
+    return f"{pid}:{BOOT_ID}:{start_time}"
+
+
+def is_owner_alive(owner):
+    """判断任务的所属进程是否仍在运行，PID 被复用时开机ID或启动时间不同，视为已退出"""
+    if not owner:
+        return False
+    pid = int(owner.split(':', 1)[0])
+    if not is_process_alive(pid):
+        return False
+    return ':' not in owner or get_owner_token(pid) == owner
+
+
+def is_process_alive(pid):
+    """判断本机上的进程是否仍在运行"""
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def claim_interrupted_jobs(active_job_ids, resume=True):
+    """
+    找出状态为 running 但所属进程已不存在的任务，并原子地改为由当前进程接管，每次接管 resume_count 加一。
+    多个工作进程同时启动时，每个任务只会被其中一个进程接管。
+    已恢复 MAX_RESUME_ATTEMPTS 次仍被中断的任务（例如每次都因内存不足导致进程崩溃）不再接管，直接标记为失败；
+    resume=False 时所有被中断的任务都标记为失败。
+    返回 (接管的任务, 放弃的任务)。
+    """
+    claimed, abandoned = [], []
+    with state_db() as conn:
+        rows = conn.execute("SELECT job_id, worker_owner, resume_count FROM jobs WHERE status = 'running'").fetchall()
+    for row in rows:
+        if row['job_id'] in active_job_ids:
+            continue
+        if row['worker_owner'] != get_owner_token() and is_owner_alive(row['worker_owner']):
+            continue
+        give_up = not resume or row['resume_count'] >= MAX_RESUME_ATTEMPTS
+        with state_db() as conn:
+            if give_up:
+                error = f"已恢复 {MAX_RESUME_ATTEMPTS} 次仍被中断，放弃执行" if resume else "任务被中断，未启用自动恢复"
+                cursor = conn.execute(
+                    "UPDATE jobs SET status = 'failed', error = ?, worker_owner = ?, updated_at = ? "
+                    "WHERE job_id = ? AND status = 'running' AND worker_owner IS ?",
+                    (error, get_owner_token(), time.time(), row['job_id'], row['worker_owner']))
+            else:
+                cursor = conn.execute(
+                    "UPDATE jobs SET worker_owner = ?, resume_count = resume_count + 1, updated_at = ? "
+                    "WHERE job_id = ? AND status = 'running' AND worker_owner IS ?",
+                    (get_owner_token(), time.time(), row['job_id'], row['worker_owner']))
+            if cursor.rowcount == 1:
+                (abandoned if give_up else claimed).append(row['job_id'])
+    return claimed, abandoned
+
+
+def get_running_job_ids():
+    with state_db() as conn:
+        return {row['job_id'] for row in conn.execute("SELECT job_id FROM jobs WHERE status = 'running'")}
+
+
+init_state_db()
+
+
+# =============================================================================
+# 📦 产物存储 - 内容哈希命名、引用索引、TTL/配额淘汰
+# =============================================================================
+evict_lock = threading.Lock()
+last_evict_time = 0     # 本进程上次淘汰扫描的时间，多进程下各自节流即可
+
+
+def touch_artifact(filename):
+    """记录产物最近一次写入/复用/下载的时间"""
+    with state_db() as conn:
+        conn.execute("INSERT OR REPLACE INTO artifacts (filename, last_access) VALUES (?, ?)", (filename, time.time()))
+
+
+def compute_dataframe_hash(df):
+    """根据 DataFrame 的列名和内容计算哈希（与 Excel 文件的元数据时间戳无关）"""
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps([str(col) for col in df.columns], ensure_ascii=False).encode('utf-8'))
+    hasher.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return hasher.hexdigest()[:ARTIFACT_HASH_LENGTH]
+
+
+def save_dataframe_artifact(df, prefix, job_id=None, sheets=None):
+    """
+    将 DataFrame 以内容哈希文件名保存到 DOWNLOAD_FOLDER，相同内容只写一次。
+    传入 job_id 时文件会被该任务引用，在 release_job_artifacts 之前不会被淘汰。
+    传入 sheets（[(工作表名, DataFrame), ...]）时改为写入多个命名工作表，df 参数被忽略。
+    """
+    if sheets:
+        hasher = hashlib.sha256()
+        for sheet_name, sheet_df in sheets:
+            hasher.update(f"{sheet_name}:{compute_dataframe_hash(sheet_df)};".encode('utf-8'))
+        content_hash = hasher.hexdigest()[:ARTIFACT_HASH_LENGTH]
+    else:
+        content_hash = compute_dataframe_hash(df)
+    filename = f"{prefix}_{content_hash}.xlsx"
+    file_path = os.path.join(DOWNLOAD_FOLDER, filename)
+
+    touch_artifact(filename)
+    if job_id is not None:
+        with state_db() as conn:
+            conn.execute("INSERT OR IGNORE INTO artifact_refs (filename, job_id) VALUES (?, ?)", (filename, job_id))
+
+    if os.path.exists(file_path):
+        if ENABLE_DEBUG_PRINT:
+            print(f"产物 {filename} 已存在，复用已有文件")
+    else:
+        # 先写临时文件再原子替换，避免下载方读到写了一半的文件
+        tmp_path = os.path.join(DOWNLOAD_FOLDER, f".tmp_{uuid.uuid4().hex[:UUID_LENGTH]}_{filename}")
+        try:
+            if sheets:
+                with pd.ExcelWriter(tmp_path) as writer:
+                    for sheet_name, sheet_df in sheets:
+                        sheet_df.to_excel(writer, sheet_name=sheet_name, index=False)
+            else:
+                df.to_excel(tmp_path, index=False)
+            os.replace(tmp_path, file_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    maybe_evict_artifacts()
+    return filename
+
+
+file_etag_cache = {}    # 文件路径 -> (mtime_ns, size, etag)
+
+
+def get_file_etag(file_path):
+    """
+    按文件字节计算强ETag。相同 DataFrame 重新写出的 xlsx 因 zip 时间戳不同而字节不同，
+    不能直接用文件名中的内容哈希，否则淘汰重建后同一ETag会对应不同字节，Range 续传会拼接出坏文件。
+    按 (mtime, size) 缓存，文件未重写时不重复计算。
+    """
+    stat = os.stat(file_path)
+    cached = file_etag_cache.get(file_path)
+    if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+    hasher = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(block)
+    etag = hasher.hexdigest()[:32]
+    file_etag_cache[file_path] = (stat.st_mtime_ns, stat.st_size, etag)
+    return etag
+
+
+def release_job_artifacts(job_id):
+    """释放任务对产物的引用，之后这些文件只受 TTL/配额约束"""
+    with state_db() as conn:
+        conn.execute("DELETE FROM artifact_refs WHERE job_id = ?", (job_id,))
+
+
+def evict_artifacts():
+    """淘汰过期文件，并在超出磁盘配额时按最久未用顺序删除，跳过被活跃任务引用的文件"""
+    now = time.time()
+    candidates = []
+    total_bytes = 0
+
+    with state_db() as conn:
+        # 只有运行中的任务的引用才保护文件；进程崩溃遗留的引用在超过TTL后失效
+        referenced = {row['filename'] for row in conn.execute(
+            "SELECT DISTINCT r.filename FROM artifact_refs r LEFT JOIN jobs j ON r.job_id = j.job_id "
+            "WHERE j.job_id IS NULL OR (j.status = 'running' AND j.updated_at > ?)",
+            (now - ARTIFACT_TTL_SECONDS,))}
+        last_access = {row['filename']: row['last_access'] for row in conn.execute("SELECT filename, last_access FROM artifacts")}
+
+    for entry in os.scandir(DOWNLOAD_FOLDER):
+        if not entry.is_file():
+            continue
+        stat = entry.stat()
+        total_bytes += stat.st_size
+        if entry.name in referenced:
+            continue
+        if entry.name.startswith('.tmp_') and now - stat.st_mtime < ARTIFACT_TTL_SECONDS:
+            # 正在写入中的临时文件
+            continue
+        used_at = max(stat.st_mtime, last_access.get(entry.name, 0))
+        candidates.append((used_at, entry.name, stat.st_size))
+
+    candidates.sort()
+    removed = 0
+    for used_at, filename, size in candidates:
+        expired = now - used_at > ARTIFACT_TTL_SECONDS
+        over_quota = total_bytes > ARTIFACT_MAX_TOTAL_BYTES
+        if not expired and not over_quota:
+            continue
+        try:
+            os.remove(os.path.join(DOWNLOAD_FOLDER, filename))
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+        removed += 1
+        with state_db() as conn:
+            conn.execute("DELETE FROM artifacts WHERE filename = ?", (filename,))
+
+    if removed and ENABLE_DEBUG_PRINT:
+        print(f"产物淘汰完成，删除 {removed} 个文件，剩余占用 {total_bytes} bytes")
+    return removed
+
+
+def maybe_evict_artifacts():
+    """按 ARTIFACT_EVICT_INTERVAL 节流执行淘汰"""
+    global last_evict_time
+    with evict_lock:
+        if time.time() - last_evict_time < ARTIFACT_EVICT_INTERVAL:
+            return
+        last_evict_time = time.time()
+    try:
+        evict_artifacts()
+    except Exception as e:
+        print(f"产物淘汰失败: {e}")
+
+
+# =============================================================================
+# ⚖️ Dify 后端池 - 负载均衡、并发上限、健康摘除与恢复
+# =============================================================================
+backend_condition = threading.Condition()
+backend_pool = []
+for index, backend_config in enumerate(DIFY_BACKENDS):
+    backend_pool.append({
+        'name': f"backend_{index}",
+        'base_url': backend_config['base_url'],
+        'api_key': backend_config['api_key'],
+        'workflow_run_url': f"{backend_config['base_url']}/workflows/run",
+        'weight': backend_config.get('weight', 1),
+        'max_concurrency': backend_config.get('max_concurrency', MAX_WORKERS),
+        'outstanding': 0,
+        'current_weight': 0,          # 平滑加权轮询使用
+        'consecutive_errors': 0,
+        'ejected_until': 0,
+    })
+job_backend_stats = {}    # job_id -> {后端名: 统计}
+
+
+def is_backend_idle(backend, now, exclude=None):
+    return (backend['ejected_until'] <= now and backend['outstanding'] < backend['max_concurrency']
+            and not (exclude and backend['name'] in exclude))
+
+
+def select_backend(now, exclude=None):
+    """在持有 backend_condition 的情况下挑选一个可用后端（跳过 exclude 中的后端名），没有可用后端时返回 None"""
+    available = [backend for backend in backend_pool if is_backend_idle(backend, now, exclude)]
+    if not available:
+        return None
+    if DIFY_BALANCE_STRATEGY == 'weighted':
+        total_weight = sum(backend['weight'] for backend in available)
+        for backend in available:
+            backend['current_weight'] += backend['weight']
+        chosen = max(available, key=lambda backend: backend['current_weight'])
+        chosen['current_weight'] -= total_weight
+        return chosen
+    return min(available, key=lambda backend: backend['outstanding'] / backend['weight'])
+
+
+def sync_backend_ejections():
+    """从共享状态库读取其他工作进程摘除的后端，合并到本进程的后端池"""
+    with state_db() as conn:
+        rows = conn.execute("SELECT base_url, ejected_until FROM backend_health WHERE ejected_until > ?",
+                            (time.time(),)).fetchall()
+    shared = {row['base_url']: row['ejected_until'] for row in rows}
+    with backend_condition:
+        for backend in backend_pool:
+            if backend['base_url'] in shared:
+                backend['ejected_until'] = max(backend['ejected_until'], shared[backend['base_url']])
+
+
+def has_idle_backend(exclude=None):
+    """是否有未被摘除、未满载且不在 exclude 中的后端"""
+    now = time.time()
+    with backend_condition:
+        return any(is_backend_idle(backend, now, exclude) for backend in backend_pool)
+
+
+def acquire_backend(cancel_event=None, block=True, exclude=None):
+    """
+    阻塞直到有后端可用，并占用它的一个并发名额（并发上限按进程计算）。
+    等待期间 cancel_event 被 set 时不再占用名额，返回 None；block=False 时没有空闲后端也直接返回 None。
+    exclude 为不参与选择的后端名集合。
+    """
+    while True:
+        sync_backend_ejections()
+        with backend_condition:
+            if cancel_event is not None and cancel_event.is_set():
+                return None
+            backend = select_backend(time.time(), exclude)
+            if backend is not None:
+                backend['outstanding'] += 1
+                return backend
+            if not block:
+                return None
+            backend_condition.wait(BACKEND_ACQUIRE_POLL_SECONDS)
+
+
+def release_backend(backend, healthy, latency, job_id=None):
+    """
+    归还并发名额并记录结果。healthy=False 表示后端本身出错（网络异常、5xx 等），
+    连续出错达到阈值时摘除 BACKEND_EJECT_SECONDS 秒，到期后自动重新接入，首次成功即恢复计数。
+    """
+    ejected_until = None
+    with backend_condition:
+        backend['outstanding'] -= 1
+        if healthy:
+            backend['consecutive_errors'] = 0
+        else:
+            backend['consecutive_errors'] += 1
+            if backend['consecutive_errors'] >= BACKEND_EJECT_AFTER_ERRORS:
+                backend['ejected_until'] = ejected_until = time.time() + BACKEND_EJECT_SECONDS
+                print(f"后端 {backend['name']} ({backend['base_url']}) 连续失败 {backend['consecutive_errors']} 次，摘除 {BACKEND_EJECT_SECONDS} 秒")
+
+        if job_id is not None:
+            stats = job_backend_stats.setdefault(job_id, {}).setdefault(backend['name'], {
+                'base_url': backend['base_url'], 'requests': 0, 'errors': 0, 'total_latency': 0.0, 'max_latency': 0.0,
+            })
+            stats['requests'] += 1
+            stats['errors'] += 0 if healthy else 1
+            stats['total_latency'] += latency
+            stats['max_latency'] = max(stats['max_latency'], latency)
+        backend_condition.notify_all()
+
+    if ejected_until is not None:
+        # 写入共享状态库，其他工作进程在下次选择后端时同样跳过它
+        with state_db() as conn:
+            conn.execute("INSERT OR REPLACE INTO backend_health (base_url, ejected_until) VALUES (?, ?)",
+                         (backend['base_url'], ejected_until))
+
+
+def pop_job_backend_stats(job_id):
+    """取出任务的各后端统计（平均/最大延迟、错误数），用于任务汇总"""
+    with backend_condition:
+        stats = job_backend_stats.pop(job_id, {})
+        ejected = {backend['name'] for backend in backend_pool if backend['ejected_until'] > time.time()}
+    summary = {}
+    for name, item in stats.items():
+        summary[name] = {
+            'base_url': item['base_url'],
+            'requests': item['requests'],
+            'errors': item['errors'],
+            'avg_latency': round(item['total_latency'] / item['requests'], 3) if item['requests'] else 0,
+            'max_latency': round(item['max_latency'], 3),
+            'ejected': name in ejected,
+        }
+    return summary
+
+
+# =============================================================================
+# 🔎 本地预筛选 - 向量化关键词匹配，只把候选行发送给Dify
+# =============================================================================
+def build_prefilter_pattern(terms):
+    """把关键词列表合并为一个正则（非正则模式下先转义）"""
+    if not terms:
+        return None
+    if not PREFILTER_USE_REGEX:
+        terms = [re.escape(term) for term in terms]
+    return '|'.join(f"(?:{term})" for term in terms)
+
+
+def prefilter_rows(df, which_aspects_value):
+    """
+    按 PREFILTER_RULES 中该 aspect 的 include/exclude 规则筛选候选行。
+    每列只做一次 str.contains，再按列做 OR 合并，不逐行循环。
+    返回 (候选行DataFrame, 被排除的行数)；没有配置规则时原样返回。
+    """
+    rules = PREFILTER_RULES.get(which_aspects_value)
+    if not rules or df.empty:
+        return df, 0
+
+    columns = [col for col in PREFILTER_COLUMNS if col in df.columns]
+    if not columns:
+        # pandas 3 的 read_excel 把文本列读成 StringDtype，不能只认 object
+        columns = [col for col in df.select_dtypes(include=['object', 'string']).columns if col != ID_COLUMN_NAME]
+    if not columns:
+        print(f"警告：'{which_aspects_value}' 配置了预筛选规则，但文件中没有可匹配的文本列，跳过预筛选")
+        return df, 0
+
+    def match_any(pattern):
+        mask = pd.Series(False, index=df.index)
+        for col in columns:
+            mask |= df[col].astype(str).str.contains(pattern, regex=True, na=False)
+        return mask
+
+    keep_mask = pd.Series(True, index=df.index)
+    include_pattern = build_prefilter_pattern(rules.get('include'))
+    if include_pattern:
+        keep_mask &= match_any(include_pattern)
+    exclude_pattern = build_prefilter_pattern(rules.get('exclude'))
+    if exclude_pattern:
+        keep_mask &= ~match_any(exclude_pattern)
+
+    df_candidates = df[keep_mask]
+    return df_candidates, len(df) - len(df_candidates)
+
+
+# =============================================================================
+# 🧬 行去重 - 相同项目只发送一个代表行，结果按组分发
+# =============================================================================
+def dedup_rows(df, key_columns=None):
+    """
+    按 key_columns（默认 DEDUP_COLUMNS）归一化（去空白、转小写）后的哈希分组，每组只保留第一行作为代表。
+    键列全为空的行无法判断是否重复，各自作为代表行。
+    返回 (代表行DataFrame, {代表id: [组内全部id]}, 被合并掉的行数)。
+    """
+    if df.empty:
+        return df, {}, 0
+
+    columns = [col for col in (key_columns or DEDUP_COLUMNS) if col in df.columns and col != ID_COLUMN_NAME]
+    if not columns:
+        columns = [col for col in df.columns if col != ID_COLUMN_NAME and col not in DEDUP_IGNORE_COLUMNS]
+    if not columns:
+        return df, {}, 0
+
+    normalized = pd.DataFrame({
+        col: df[col].fillna('').astype(str).str.replace(r'\s+', '', regex=True).str.lower()
+        for col in columns
+    })
+    row_hashes = pd.util.hash_pandas_object(normalized, index=False).astype(str)
+    blank = (normalized == '').all(axis=1)
+    group_keys = ('h' + row_hashes).where(~blank, 'id' + df[ID_COLUMN_NAME].astype(str))
+
+    representative_ids = df[ID_COLUMN_NAME].groupby(group_keys.values).transform('first')
+    members = df[ID_COLUMN_NAME].groupby(representative_ids.values).apply(list).to_dict()
+    df_representatives = df[~group_keys.duplicated().values]
+    return df_representatives, members, len(df) - len(df_representatives)
+
+
+def expand_dedup_ids(ids, dedup_members):
+    """把Dify返回的代表id展开为组内全部id"""
+    if not dedup_members:
+        return ids
+    expanded = []
+    for cid in ids:
+        expanded.extend(dedup_members.get(cid, [cid]))
+    return expanded
+
+
+# =============================================================================
+# ✂️ 列投影 - 只发送分类所需的列，完整行在汇总时从 df_large 重建
+# =============================================================================
+def get_projection_columns(df, which_aspects_value):
+    """返回要发送给Dify的列（id列在最前）；配置的列都不存在时返回 None 表示发送全部列"""
+    configured = PROJECTION_COLUMNS_BY_ASPECT.get(which_aspects_value, PROJECTION_COLUMNS)
+    columns = [col for col in configured if col in df.columns and col != ID_COLUMN_NAME]
+    if not columns:
+        print(f"警告：列投影配置的列 {configured} 在文件中都不存在，发送全部列")
+        return None
+    return [ID_COLUMN_NAME] + columns
+
+
+def parse_aspects_param(default):
+    """读取 which_aspects：可重复传多个字段，也可以传一个JSON数组字符串；去重后保持顺序"""
+    aspects = []
+    for value in request.form.getlist('which_aspects'):
+        value = value.strip()
+        if not value:
+            continue
+        if value.startswith('['):
+            try:
+                aspects.extend(str(item).strip() for item in json.loads(value) if str(item).strip())
+                continue
+            except ValueError:
+                pass
+        aspects.append(value)
+    aspects = list(dict.fromkeys(aspects))
+    return aspects or [default]
+
+
+def parse_bool_param(name, default):
+    """读取表单中的布尔开关参数，未传时使用默认值"""
+    value = request.form.get(name)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes')
+
+
+class AttemptCancelEvent(threading.Event):
+    """
+    对冲请求的取消标记。set() 时关闭已登记的响应流，正在阻塞读取的线程随即结束，
+    并唤醒正在等待后端名额的线程，被取消的请求不会一直占用后端名额和线程直到超时。
+    关闭连接并不会停止Dify端的流式工作流，已知 task_id 时还会调用停止接口，避免继续消耗模型调用。
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.backend = None
+        self.response = None
+        self.task_id = None
+        self.task_stopped = False
+        self.response_lock = threading.Lock()
+
+    def attach(self, response):
+        """登记请求的响应流；已被取消时返回 False，由调用方关闭响应"""
+        with self.response_lock:
+            if self.is_set():
+                return False
+            self.response = response
+            return True
+
+    def record_task(self, task_id):
+        """登记Dify返回的 task_id；此时已被取消则立即停止该任务"""
+        with self.response_lock:
+            if self.task_id is not None:
+                return
+            self.task_id = task_id
+            cancelled = self.is_set()
+        if cancelled:
+            self.stop_task()
+
+    def stop_task(self):
+        """在后台调用 /workflows/tasks/{task_id}/stop 停止Dify端的工作流，每个任务只停止一次"""
+        with self.response_lock:
+            if self.task_id is None or self.backend is None or self.task_stopped:
+                return
+            self.task_stopped = True
+            backend, task_id = self.backend, self.task_id
+
+        def stop():
+            try:
+                requests.post(f"{backend['base_url']}/workflows/tasks/{task_id}/stop",
+                              headers={'Authorization': backend['api_key'], 'Content-Type': 'application/json'},
+                              json={'user': DIFY_WORKFLOW_USER}, timeout=TASK_STOP_TIMEOUT)
+                print(f"已停止被对冲取消的Dify任务 {task_id} (后端: {backend['name']})")
+            except Exception as e:
+                logging.error(f"停止Dify任务 {task_id} 失败: {e}")
+
+        threading.Thread(target=stop, daemon=True).start()
 
+    def set(self):
+        with self.response_lock:
+            super().set()
+            response = self.response
+        self.stop_task()
+        if response is not None:
+            close_response(response)
+        with backend_condition:
+            backend_condition.notify_all()
 
 
-def process_streaming_response(response):
+def close_response(response):
+    """关闭响应流；urllib3 2.3+ 的 shutdown() 可以唤醒其他线程中阻塞的读取"""
+    try:
+        shutdown = getattr(getattr(response, 'raw', None), 'shutdown', None)
+        if shutdown is not None:
+            shutdown()
+        response.close()
+    except Exception as e:
+        logging.error(f"关闭响应流时出错: {e}")
+
+
+def process_streaming_response(response, cancel_event=None):
     """
     处理Dify的streaming响应，获取工作流的最终输出
+    cancel_event 被 set 时（对冲请求中另一方已完成）放弃读取；AttemptCancelEvent 会直接关闭响应流
     """
     if response.status_code != 200:
         # 保存响应文本用于错误信息
@@ -113,6 +948,8 @@ def process_streaming_response(response):
     try:
         # 收集所有响应行
         for line in response.iter_lines():
+            if cancel_event is not None and cancel_event.is_set():
+                return ""
             if not line:
                 continue
                 
@@ -126,6 +963,9 @@ def process_streaming_response(response):
             try:
                 message = json.loads(data_content)
                 all_events.append(message)
+                # 记录 task_id（workflow_started 起每个事件都带），取消时据此停止Dify端的任务
+                if isinstance(cancel_event, AttemptCancelEvent) and message.get('task_id'):
+                    cancel_event.record_task(message['task_id'])
                 
                 # 查找工作流完成事件
                 if message.get('event') == 'workflow_finished':
@@ -148,7 +988,9 @@ def process_streaming_response(response):
                 continue
                 
     except Exception as e:
-        logging.error(f"处理streaming响应时出错: {e}")
+        # 被取消的请求由 AttemptCancelEvent 关闭响应流，读取报错属于预期
+        if cancel_event is None or not cancel_event.is_set():
+            logging.error(f"处理streaming响应时出错: {e}")
         
     finally:
         response.close()
@@ -166,19 +1008,18 @@ def process_streaming_response(response):
 
 
 # 3. 并行任务单元函数
-def call_small_workflow(chunk_id, df_chunk, which_aspects_value=None):
+def call_small_workflow(chunk_id, df_chunk, which_aspects_value=None, job_id=None, cancel_event=None, wait_for_backend=True,
+                        exclude_backends=None):
     print(f"开始处理 Chunk #{chunk_id}...")
     
     try:
         # --- 第一步: 保存切分文件到可访问位置并生成URL ---
         print(f"正在为 Chunk #{chunk_id} 保存文件并生成访问URL...")
         
-        # 生成唯一文件名
-        unique_filename = f"chunk_{chunk_id}_{uuid.uuid4().hex[:UUID_LENGTH]}.xlsx"
-        file_path = os.path.join(DOWNLOAD_FOLDER, unique_filename)
-        
-        # 保存Excel文件
-        df_chunk.to_excel(file_path, index=False)
+        # 按内容哈希保存Excel文件（重试或相同内容的chunk复用同一文件）
+        unique_filename = save_dataframe_artifact(df_chunk, "chunk", job_id)
+        if job_id is not None:
+            record_chunk_status(job_id, chunk_id, artifact=unique_filename)
         
         # 生成文件访问URL (使用当前服务的端口)
         file_url = f"http://{FILE_SERVER_HOST}:{FILE_SERVER_PORT}/downloads/{unique_filename}"
@@ -201,28 +1042,59 @@ def call_small_workflow(chunk_id, df_chunk, which_aspects_value=None):
                 "which_aspects": which_aspects_value  # 直接传递字符串值，不需要包装成对象
             },
             "response_mode": "streaming",  # 参考 func.py，使用 streaming 模式
-            "user": 'backend_service_user'
+            "user": DIFY_WORKFLOW_USER
         }
-        headers_run = {'Authorization': DIFY_API_KEY, 'Content-Type': 'application/json'}
+        # 被对冲取消的请求不计入后端健康度，也不再发出
+        cancelled_result = {'chunk_id': chunk_id, 'status': 'FAILED', 'error': f"Chunk #{chunk_id} 的请求已被对冲取消"}
+        # 从后端池中选择一个Dify后端（负载均衡 + 并发上限）；等待名额期间被取消则直接返回。
+        # 对冲请求不排队等名额，否则原请求完成归还名额后，对冲请求可能在被取消前抢到名额并发出
+        backend = acquire_backend(cancel_event, block=wait_for_backend, exclude=exclude_backends)
+        if isinstance(cancel_event, AttemptCancelEvent):
+            cancel_event.backend = backend
+        if backend is None:
+            if cancel_event is not None and cancel_event.is_set():
+                return cancelled_result
+            return {'chunk_id': chunk_id, 'status': 'FAILED', 'error': f"Chunk #{chunk_id} 没有空闲的Dify后端，放弃对冲请求"}
+        headers_run = {'Authorization': backend['api_key'], 'Content-Type': 'application/json'}
+        backend_healthy = False
+        backend_started = time.time()
 
-        print(f"正在为 Chunk #{chunk_id} 运行工作流...")
-        print(f"工作流请求payload: {json.dumps(payload, ensure_ascii=False)}")
-        run_response = requests.post(DIFY_WORKFLOW_RUN_URL, headers=headers_run, json=payload, timeout=REQUEST_TIMEOUT, stream=True)
-        
-        # 打印响应状态码和头信息用于调试
-        print(f"工作流响应状态码: {run_response.status_code}")
-        print(f"工作流响应头: {dict(run_response.headers)}")
-        
-        # 特殊处理400错误
-        if run_response.status_code == 400:
-            error_msg = f"Chunk #{chunk_id} 工作流请求400错误: {run_response.text}"
-            print(error_msg)
-            return {'chunk_id': chunk_id, 'status': 'FAILED', 'error': error_msg}
-        
-        run_response.raise_for_status() 
-        
-        # 处理streaming响应，参考func.py的实现
-        streaming_result = process_streaming_response(run_response)
+        try:
+            print(f"正在为 Chunk #{chunk_id} 运行工作流 (后端: {backend['name']})...")
+            print(f"工作流请求payload: {json.dumps(payload, ensure_ascii=False)}")
+            if cancel_event is not None and cancel_event.is_set():
+                backend_healthy = True
+                return cancelled_result
+            run_response = requests.post(backend['workflow_run_url'], headers=headers_run, json=payload, timeout=REQUEST_TIMEOUT, stream=True)
+            # 登记响应流，取消时由另一方直接关闭；发请求期间已被取消则立即关闭
+            if isinstance(cancel_event, AttemptCancelEvent) and not cancel_event.attach(run_response):
+                close_response(run_response)
+                backend_healthy = True
+                return cancelled_result
+            
+            # 打印响应状态码和头信息用于调试
+            print(f"工作流响应状态码: {run_response.status_code}")
+            print(f"工作流响应头: {dict(run_response.headers)}")
+            
+            # 特殊处理400错误（请求本身的问题，不计入后端健康度）
+            if run_response.status_code == 400:
+                backend_healthy = True
+                error_msg = f"Chunk #{chunk_id} 工作流请求400错误: {run_response.text}"
+                print(error_msg)
+                return {'chunk_id': chunk_id, 'status': 'FAILED', 'error': error_msg}
+            
+            run_response.raise_for_status() 
+            
+            # 处理streaming响应，参考func.py的实现
+            streaming_result = process_streaming_response(run_response, cancel_event)
+            if cancel_event is not None and cancel_event.is_set():
+                backend_healthy = True
+                return cancelled_result
+            backend_healthy = bool(streaming_result)
+        finally:
+            # 被取消的对冲请求可能在任务结束后才返回，不再计入任务统计
+            cancelled = cancel_event is not None and cancel_event.is_set()
+            release_backend(backend, backend_healthy, time.time() - backend_started, None if cancelled else job_id)
         if ENABLE_DEBUG_PRINT:
             print(f"Chunk #{chunk_id} streaming响应结果: {streaming_result[:MAX_DEBUG_OUTPUT_LENGTH]}...")
         
@@ -501,8 +1373,594 @@ def proxy_dify_workflow():
 def download_file(filename):
     """
     从DOWNLOAD_FOLDER目录中提供静态文件下载。
+    支持 ETag / If-None-Match / If-Modified-Since 条件请求和 Range 断点续传，
+    可选通过 X-Sendfile 或 Nginx X-Accel-Redirect 卸载文件发送。
+    """
+    file_path = safe_join(os.path.abspath(DOWNLOAD_FOLDER), filename)
+    if file_path is None or not os.path.isfile(file_path):
+        abort(404)
+
+    touch_artifact(filename)
+
+    # 强ETag按文件字节计算；内容哈希命名的文件数据不变，可以标记为 immutable
+    stem = filename.rsplit('.', 1)[0]
+    content_hash = stem.rsplit('_', 1)[-1]
+    is_hashed = len(content_hash) == ARTIFACT_HASH_LENGTH and all(c in '0123456789abcdef' for c in content_hash)
+    etag = get_file_etag(file_path)
+
+    if DOWNLOAD_OFFLOAD_MODE == 'x-accel':
+        response = app.response_class()
+        response.headers['X-Accel-Redirect'] = f"{X_ACCEL_REDIRECT_PREFIX}{filename}"
+        response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+        response.set_etag(etag)
+        response.cache_control.max_age = DOWNLOAD_CACHE_MAX_AGE
+        response.cache_control.public = True
+        return response
+
+    response = send_file(
+        file_path,
+        as_attachment=True,
+        conditional=True,
+        etag=etag,
+        max_age=DOWNLOAD_CACHE_MAX_AGE,
+    )
+    if is_hashed:
+        response.cache_control.immutable = True
+    return response
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
     """
-    return send_from_directory(DOWNLOAD_FOLDER, filename, as_attachment=True)
+    查询任务进度。任务状态保存在共享状态库中，任何工作进程都能回答。
+    """
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "任务不存在", "job_id": job_id}), 404
+    return jsonify(job)
+
+# =============================================================================
+# 💾 任务检查点 - 输入文件和chunk计划落盘，每个chunk的结果实时写入共享状态库
+# =============================================================================
+active_job_ids = set()    # 本进程正在执行的任务
+active_jobs_lock = threading.Lock()
+
+
+def get_job_checkpoint_dir(job_id):
+    return os.path.join(JOB_CHECKPOINT_FOLDER, job_id)
+
+
+def load_job_input(input_path):
+    """读取上传的Excel并新增自增id列（首次处理和断点续跑都走这里，保证id一致）"""
+    df_large = pd.read_excel(input_path)
+    # 真正新增一列自增 id，而不是用旧索引
+    df_large.insert(0, ID_COLUMN_NAME, range(len(df_large)))
+    print(f"成功加载Excel并自动添加了 '{ID_COLUMN_NAME}' 列。总行数: {len(df_large)}")
+    return df_large
+
+
+def save_job_manifest(job_id, manifest):
+    """原子地写入任务的chunk计划"""
+    manifest_path = os.path.join(get_job_checkpoint_dir(job_id), 'manifest.json')
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_path, manifest_path)
+
+
+def load_job_manifest(job_id):
+    with open(os.path.join(get_job_checkpoint_dir(job_id), 'manifest.json'), encoding='utf-8') as f:
+        manifest = json.load(f)
+    # JSON 的对象键都是字符串，还原为整数id
+    manifest['chunks'] = {int(chunk_id): ids for chunk_id, ids in manifest['chunks'].items()}
+    manifest['dedup_members'] = {int(rep_id): ids for rep_id, ids in manifest['dedup_members'].items()}
+    return manifest
+
+
+def plan_job(job_id, df_large, aspects, prefilter_enabled, dedup_enabled, projection_enabled=False,
+             hedging_enabled=False, aspect_sheets_enabled=False):
+    """
+    预筛选、去重、确定发送的列并切分chunk，返回可落盘的任务计划。
+    多个 aspects 共用同一套chunk：按各方面候选行的并集切分chunk，列投影取各方面列的并集；
+    每个方面只调度含有自己候选行的chunk，汇总时也只保留自己的候选行。
+    """
+    chunk_size = DEFAULT_CHUNK_SIZE  # 从配置读取
+    print(f"使用chunk大小: {chunk_size} 行")
+
+    # 本地预筛选：明显无关的行直接跳过，不再发送给Dify
+    df_candidates = df_large
+    prefilter_skipped_rows = 0
+    aspect_candidate_ids = [None] * len(aspects)    # 每个方面的候选行id，None 表示该方面没有预筛选规则
+    if prefilter_enabled:
+        candidate_index = None
+        for aspect_index, which_aspects in enumerate(aspects):
+            df_aspect, _ = prefilter_rows(df_large, which_aspects)
+            if which_aspects in PREFILTER_RULES:
+                aspect_candidate_ids[aspect_index] = [int(row_id) for row_id in df_aspect[ID_COLUMN_NAME]]
+            candidate_index = df_aspect.index if candidate_index is None else candidate_index.union(df_aspect.index)
+        df_candidates = df_large.loc[candidate_index.sort_values()]
+        prefilter_skipped_rows = len(df_large) - len(df_candidates)
+        print(f"预筛选完成: 候选行 {len(df_candidates)}，跳过 {prefilter_skipped_rows} 行")
+    candidate_rows = len(df_candidates)
+
+    # 列投影：只把id和分类需要的列发送给Dify（任一方面无法投影时发送全部列）
+    projection_columns = None
+    if projection_enabled:
+        projection_columns = []
+        for which_aspects in aspects:
+            aspect_columns = get_projection_columns(df_large, which_aspects)
+            if aspect_columns is None:
+                projection_columns = None
+                break
+            projection_columns += [col for col in aspect_columns if col not in projection_columns]
+    if projection_columns:
+        print(f"列投影: 发送 {len(projection_columns)}/{len(df_large.columns)} 列 {projection_columns}")
+
+    # 行去重：重复项目只发送一个代表行，结果汇总时再分发回全部重复行。
+    # 启用列投影时按实际发送的列判断重复，否则Dify可能判断不同的行会被合并
+    dedup_members = {}
+    dedup_merged_rows = 0
+    if dedup_enabled:
+        df_candidates, dedup_members, dedup_merged_rows = dedup_rows(df_candidates, projection_columns)
+        print(f"行去重完成: 代表行 {len(df_candidates)}，合并 {dedup_merged_rows} 行")
+
+    # 创建chunk计划 - 只记录每个chunk包含的id，chunk内容随时可从输入文件重建
+    candidate_ids = [int(row_id) for row_id in df_candidates[ID_COLUMN_NAME]]
+    chunks = {i // chunk_size: candidate_ids[i:i + chunk_size] for i in range(0, len(candidate_ids), chunk_size)}
+
+    # 每个方面需要调用的chunk：chunk中（含去重合并的重复行）至少有一行是该方面的候选行
+    aspect_chunks = []
+    for candidate_list in aspect_candidate_ids:
+        if candidate_list is None:
+            aspect_chunks.append(sorted(chunks))
+            continue
+        candidate_set = set(candidate_list)
+        aspect_chunks.append([
+            chunk_id for chunk_id, row_ids in sorted(chunks.items())
+            if any(row_id in candidate_set for row_id in expand_dedup_ids(row_ids, dedup_members))
+        ])
+    total_tasks = len(chunks) * len(aspects)
+    planned_tasks = sum(len(chunk_ids) for chunk_ids in aspect_chunks)
+    if planned_tasks < total_tasks:
+        print(f"按方面预筛选: 跳过 {total_tasks - planned_tasks}/{total_tasks} 个 (chunk, aspect) 调用")
+
+    return {
+        'job_id': job_id,
+        'aspects': aspects,
+        'aspect_sheets_enabled': aspect_sheets_enabled,
+        'chunk_size': chunk_size,
+        'chunks': chunks,
+        'aspect_chunks': aspect_chunks,
+        'aspect_candidate_ids': aspect_candidate_ids,
+        'dedup_members': {int(rep_id): [int(member) for member in members] for rep_id, members in dedup_members.items()},
+        'projection_columns': projection_columns,
+        'hedging_enabled': hedging_enabled,
+        'prefilter': {
+            'enabled': prefilter_enabled,
+            'total_rows': len(df_large),
+            'candidate_rows': candidate_rows,
+            'short_circuited_rows': prefilter_skipped_rows,
+            'candidate_rows_by_aspect': {
+                which_aspects: len(candidate_list) if candidate_list is not None else len(df_large)
+                for which_aspects, candidate_list in zip(aspects, aspect_candidate_ids)
+            },
+            'short_circuited_tasks': total_tasks - planned_tasks,
+        },
+        'dedup': {
+            'enabled': dedup_enabled,
+            'dispatched_rows': len(df_candidates),
+            'merged_rows': dedup_merged_rows,
+        },
+        'projection': {
+            'enabled': projection_columns is not None,
+            'sent_columns': len(projection_columns) if projection_columns else len(df_large.columns),
+            'total_columns': len(df_large.columns),
+        },
+    }
+
+
+def safe_sheet_name(name, used_names):
+    """Excel 工作表名最长31个字符，且不能包含 []:*?/\\"""
+    cleaned = ''.join('_' if char in '[]:*?/\\' else char for char in str(name)).strip() or 'Sheet'
+    cleaned = cleaned[:31]
+    candidate, index = cleaned, 1
+    while candidate in used_names:
+        suffix = f"_{index}"
+        candidate = cleaned[:31 - len(suffix)] + suffix
+        index += 1
+    used_names.add(candidate)
+    return candidate
+
+
+def collect_verdict_ids(verdicts_by_chunk, dedup_members, candidate_ids=None):
+    """
+    按chunk顺序汇总小Dify返回的id，去重结果分发回全部重复行。
+    candidate_ids 不为 None 时丢弃不在该方面预筛选候选行中的id（chunk 是多个方面共用的）。
+    """
+    all_filtered_ids = []
+    seen_ids = set()
+    for chunk_id in sorted(verdicts_by_chunk):
+        for cid in expand_dedup_ids(verdicts_by_chunk[chunk_id], dedup_members):
+            if cid in seen_ids or (candidate_ids is not None and cid not in candidate_ids):
+                continue
+            seen_ids.add(cid)
+            all_filtered_ids.append(cid)
+    return all_filtered_ids
+
+
+def build_filtered_results(df_large, all_filtered_ids):
+    """从 df_large 中取出命中id的完整行，去重并排序。返回 (结果DataFrame, 结果JSON列表)。"""
+
+    # 使用小 Dify 返回的 id 从 df_large 中提取完整行，并移除 ID 列
+    final_results_df = df_large[df_large[ID_COLUMN_NAME].isin(all_filtered_ids)].copy()
+    final_results_df = final_results_df.drop(columns=[ID_COLUMN_NAME], errors='ignore').reset_index(drop=True)
+
+    # 假设关键词列名为 '关键词'，将其移到第一列（如果存在）
+    if '关键词' in final_results_df.columns:
+        columns = ['关键词'] + [col for col in final_results_df.columns if col != '关键词']
+        final_results_df = final_results_df[columns]
+
+    final_results_json = []
+    # 在保存最终结果文件之前进行排序和去重
+    if not final_results_df.empty:
+        # 先去重 - 基于所有列的组合去重
+        print(f"去重前记录数: {len(final_results_df)}")
+        final_results_df = final_results_df.drop_duplicates()
+        print(f"去重后记录数: {len(final_results_df)}")
+        
+        # 确保关键词和时间列存在
+        if '关键词' in final_results_df.columns and '时间' in final_results_df.columns:
+            print("正在对最终结果进行排序：先按关键词，再按时间...")
+            # 先按关键词排序，同类别内再按时间排序
+            final_results_df = final_results_df.sort_values(['关键词', '时间'], ascending=[True, True])
+            print(f"排序完成，共 {len(final_results_df)} 条记录")
+        else:
+            print("警告：未找到关键词或时间列，跳过排序")
+            
+        # 构建final_results_json以确保与DataFrame一致
+        for _, row in final_results_df.iterrows():
+            row_dict = row.to_dict()
+            # 删除可能的剩余ID列
+            for col in COLUMNS_TO_REMOVE:
+                if col in row_dict:
+                    del row_dict[col]
+            final_results_json.append(row_dict)
+    else:
+        final_results_df = pd.DataFrame()
+    return final_results_df, final_results_json
+
+
+def clean_output_dataframe(final_df_to_save):
+    """保存文件前确保移除所有可能的ID列和索引列"""
+    # 检查并删除所有可能的ID列
+    for col in COLUMNS_TO_REMOVE:
+        if col in final_df_to_save.columns:
+            final_df_to_save = final_df_to_save.drop(columns=[col])
+    
+    # 检查是否有数字索引列（通常是第一列）
+    if len(final_df_to_save.columns) > 0:
+        first_col = final_df_to_save.columns[0]
+        # 如果第一列是数字且不是预期的关键词列，则删除它
+        if str(first_col).isdigit() or first_col in ['index', 'Unnamed: 0']:
+            final_df_to_save = final_df_to_save.drop(columns=[first_col])
+    return final_df_to_save
+
+
+def run_job(job_id, df_large, manifest, completed_verdicts, start_time):
+    """
+    执行任务中尚未完成的 (chunk, aspect) 调用并汇总结果。completed_verdicts 中已有结果的调用不会再请求Dify，
+    因此中断后续跑与一次跑完得到相同的最终输出。多个方面共用同一套chunk文件，所有调用一起调度。
+    """
+    aspects = manifest['aspects']
+    dedup_members = manifest['dedup_members']
+    # 发送给Dify的视图只含投影列，汇总时仍从完整的 df_large 中按id取整行
+    df_view = df_large[manifest['projection_columns']] if manifest['projection_columns'] else df_large
+    df_chunks = [(chunk_id, df_view.loc[row_ids]) for chunk_id, row_ids in sorted(manifest['chunks'].items())]
+    total_chunks = len(df_chunks)
+
+    # 存储所有结果的线程安全容器，键为 (chunk_id, aspect_index)
+    results_lock = threading.Lock()
+    chunk_verdicts = dict(completed_verdicts)
+
+    # 每个方面需要调用的chunk（预筛选后没有该方面候选行的chunk不调用）
+    aspect_chunks = [set(chunk_ids) for chunk_ids in manifest['aspect_chunks']]
+
+    # 跟踪每个 (chunk, aspect) 的处理状态
+    chunk_status = {}
+    pending_tasks = []
+    for chunk_id, chunk_df in df_chunks:
+        for aspect_index in range(len(aspects)):
+            if chunk_id not in aspect_chunks[aspect_index]:
+                continue
+            task_key = (chunk_id, aspect_index)
+            chunk_status[task_key] = {'status': 'success' if task_key in chunk_verdicts else 'pending', 'retries': 0}
+            if task_key not in chunk_verdicts:
+                pending_tasks.append((chunk_id, chunk_df, aspect_index))
+    total_tasks = len(chunk_status)
+    if completed_verdicts:
+        print(f"任务 {job_id} 从检查点恢复: 已完成 {len(completed_verdicts)} 个调用，剩余 {len(pending_tasks)} 个")
+
+    # 对冲请求：已完成调用的耗时样本和本任务的对冲预算
+    hedging_enabled = manifest['hedging_enabled']
+    chunk_durations = []
+    hedge_stats = {
+        'enabled': hedging_enabled,
+        'percentile': HEDGE_PERCENTILE,
+        'budget': max(HEDGE_MIN_BUDGET, math.ceil(len(pending_tasks) * HEDGE_BUDGET_RATIO)),
+        'launched': 0,
+        'hedge_wins': 0,
+    }
+    attempt_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS * 2) if hedging_enabled else None
+
+    def current_hedge_threshold():
+        """本任务已完成chunk耗时的 HEDGE_PERCENTILE 分位数，样本不足时返回 None"""
+        with results_lock:
+            if len(chunk_durations) < HEDGE_MIN_SAMPLES:
+                return None
+            durations = sorted(chunk_durations)
+        return durations[min(len(durations) - 1, int(len(durations) * HEDGE_PERCENTILE))]
+
+    def call_with_hedging(chunk_id, chunk_df, which_aspects_value):
+        """
+        调用一次工作流；耗时超过分位数阈值、预算未用完且有空闲后端时再发一个相同请求，
+        取先成功的结果，另一个通过 AttemptCancelEvent 取消（关闭响应流并归还后端名额）。
+        """
+        started = time.time()
+        if attempt_executor is None:
+            result = call_small_workflow(chunk_id, chunk_df, which_aspects_value, job_id)
+        else:
+            cancel_events = {}
+
+            def submit_attempt(wait_for_backend=True, exclude_backends=None):
+                cancel_event = AttemptCancelEvent()
+                future = attempt_executor.submit(call_small_workflow, chunk_id, chunk_df, which_aspects_value, job_id,
+                                                 cancel_event, wait_for_backend, exclude_backends)
+                cancel_events[future] = cancel_event
+                return future
+
+            primary = submit_attempt()
+            primary_event = cancel_events[primary]
+            running = {primary}
+            while len(cancel_events) == 1 and not primary.done():
+                wait(running, timeout=HEDGE_POLL_SECONDS)
+                threshold = current_hedge_threshold()
+                if primary.done() or threshold is None or time.time() - started <= threshold:
+                    continue
+                # 有多个后端时对冲请求不发往原请求所在的（可能正卡住的）后端；所有后端都满载时对冲只会排队，等有空闲名额再发
+                exclude_backends = None
+                if len(backend_pool) > 1 and primary_event.backend is not None:
+                    exclude_backends = {primary_event.backend['name']}
+                if not has_idle_backend(exclude_backends):
+                    continue
+                with results_lock:
+                    if hedge_stats['launched'] >= hedge_stats['budget']:
+                        break
+                    hedge_stats['launched'] += 1
+                print(f"Chunk #{chunk_id} 已运行 {time.time() - started:.1f} 秒，超过 p{int(HEDGE_PERCENTILE * 100)} 阈值 {threshold:.1f} 秒，发出对冲请求")
+                running.add(submit_attempt(wait_for_backend=False, exclude_backends=exclude_backends))
+
+            # 取先成功的一方；先完成的失败了就继续等另一方
+            result = None
+            while running:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    attempt_result = future.result()
+                    if result is None or (attempt_result['status'] == 'SUCCESS' and result['status'] != 'SUCCESS'):
+                        result = attempt_result
+                        if attempt_result['status'] == 'SUCCESS' and future is not primary:
+                            with results_lock:
+                                hedge_stats['hedge_wins'] += 1
+                if result['status'] == 'SUCCESS':
+                    break
+            for future in running:
+                cancel_events[future].set()
+
+        if result['status'] == 'SUCCESS':
+            with results_lock:
+                chunk_durations.append(time.time() - started)
+        return result
+
+    def process_chunk_concurrent(chunk_id, chunk_df, aspect_index):
+        """并发处理单个 (chunk, aspect)，支持无限重试直到成功"""
+        task_key = (chunk_id, aspect_index)
+        retry = 0
+        while True:  # 无限循环直到成功
+            try:
+                result = call_with_hedging(chunk_id, chunk_df, aspects[aspect_index])
+                if result['status'] == 'SUCCESS':
+                    # 先把结果写入检查点，再标记为成功
+                    verdict_ids = result.get('data') or []
+                    record_chunk_status(job_id, chunk_id, status='success', verdict_ids=verdict_ids, aspect_index=aspect_index)
+                    # 线程安全地处理结果
+                    with results_lock:
+                        chunk_status[task_key]['status'] = 'success'  # 标记为成功状态
+                        chunk_verdicts[task_key] = verdict_ids
+                    return {'status': 'SUCCESS', 'chunk_id': chunk_id, 'download_url': result.get('download_url', '')}
+                else:
+                    # 失败重试
+                    retry += 1
+                    with results_lock:
+                        chunk_status[task_key]['retries'] += 1
+                    record_chunk_status(job_id, chunk_id, retries=retry, aspect_index=aspect_index)
+                    print(f"Chunk #{chunk_id} 第{retry}次重试...")
+                    time.sleep(RETRY_DELAY)
+            except Exception as e:
+                # 异常重试
+                retry += 1
+                with results_lock:
+                    chunk_status[task_key]['retries'] += 1
+                record_chunk_status(job_id, chunk_id, retries=retry, aspect_index=aspect_index)
+                print(f"Chunk #{chunk_id} 第{retry}次重试，异常: {str(e)[:100]}...")
+                time.sleep(RETRY_DELAY)
+
+    # 并发处理所有未完成的 (chunk, aspect) - 完全随机并发，不限制顺序
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # 一次性提交所有任务，让线程池自由调度
+        future_to_chunk = {
+            executor.submit(process_chunk_concurrent, chunk_id, chunk_df, aspect_index): chunk_id 
+            for chunk_id, chunk_df, aspect_index in pending_tasks
+        }
+        
+        # 实时处理完成的任务（无需等待批次）
+        for future in as_completed(future_to_chunk):
+            result = future.result()
+            if result and result.get('status') == 'FAILED':
+                chunk_id = result.get('chunk_id', '未知')
+                print(f"Chunk {chunk_id} 处理失败: {result.get('error', '未知错误')}")
+            elif result and result.get('status') == 'SUCCESS':
+                chunk_id = result.get('chunk_id', '未知')
+                print(f"Chunk {chunk_id} 处理成功")
+    if attempt_executor is not None:
+        # 被取消的对冲请求会在收到下一个事件时自行结束，不必等待
+        attempt_executor.shutdown(wait=False)
+                
+    # 显示最终处理统计
+    successful_tasks = len([key for key, status in chunk_status.items() if status['status'] == 'success'])
+    successful_chunks = len([chunk_id for chunk_id, _ in df_chunks
+                             if all(status['status'] == 'success' for (task_chunk_id, _), status in chunk_status.items()
+                                    if task_chunk_id == chunk_id)])
+    print(f"处理完成 - 总chunk数: {total_chunks}, 成功: {successful_chunks}")
+
+    # 按方面分别汇总结果；多方面任务另外给出命中任一方面的汇总结果
+    aspect_candidate_ids = manifest['aspect_candidate_ids']
+    results_by_aspect = {}
+    combined_ids = {}
+    for aspect_index, which_aspects in enumerate(aspects):
+        aspect_verdicts = {chunk_id: ids for (chunk_id, index), ids in chunk_verdicts.items() if index == aspect_index}
+        candidate_list = aspect_candidate_ids[aspect_index]
+        aspect_ids = collect_verdict_ids(aspect_verdicts, dedup_members,
+                                         set(candidate_list) if candidate_list is not None else None)
+        combined_ids.update(dict.fromkeys(aspect_ids))
+        results_by_aspect[which_aspects] = build_filtered_results(df_large, aspect_ids)
+
+    if len(aspects) == 1:
+        final_results_df, final_results_json = results_by_aspect[aspects[0]]
+    else:
+        final_results_df, final_results_json = build_filtered_results(df_large, list(combined_ids))
+
+    # 使用最终处理的数据
+    final_df_to_save = clean_output_dataframe(final_results_df)
+    output_sheets = None
+    if len(aspects) > 1 and manifest['aspect_sheets_enabled']:
+        used_names = set()
+        output_sheets = [(safe_sheet_name(ALL_ASPECTS_SHEET_NAME, used_names), final_df_to_save)]
+        for which_aspects, (aspect_df, _) in results_by_aspect.items():
+            output_sheets.append((safe_sheet_name(which_aspects, used_names), clean_output_dataframe(aspect_df)))
+    
+    # 确保不保存索引作为列（按内容哈希命名，相同结果复用同一文件）
+    final_filename = save_dataframe_artifact(final_df_to_save, "final_result", job_id, sheets=output_sheets)
+    final_filepath = os.path.join(DOWNLOAD_FOLDER, final_filename)
+    
+    # 上传文件到文件服务器
+    try:
+        with open(final_filepath, 'rb') as f:
+            files = {'file': (final_filename, f, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')}
+            upload_response = requests.post(f"http://{FILE_SERVER_HOST}:{FILE_SERVER_PORT}/upload", files=files)
+            upload_response.raise_for_status()
+            final_download_url = upload_response.json().get('download_url', '')
+    except Exception as e:
+        final_download_url = f"http://{FILE_SERVER_HOST}:{FILE_SERVER_PORT}/downloads/{final_filename}"
+    
+    end_time = time.time()
+    
+    # 构建返回结果
+    update_job(job_id, status='completed', final_download_url=final_download_url)
+    response_data = {
+        "message": "处理完成",
+        "job_id": job_id,
+        "summary": { 
+            "total_chunks": total_chunks, 
+            "successful_chunks": successful_chunks,
+            "total_tasks": total_tasks,  # chunk数 x 方面数
+            "successful_tasks": successful_tasks,
+            "resumed_tasks": len(completed_verdicts),
+            "chunk_size": manifest['chunk_size'],
+            "retry_mode": "infinite_retries",  # 标识使用无限重试模式
+            "backend_stats": pop_job_backend_stats(job_id),
+            "prefilter": manifest['prefilter'],
+            "dedup": manifest['dedup'],
+            "projection": manifest['projection'],
+            "hedging": hedge_stats
+        },
+        "processing_time": f"{end_time - start_time:.2f} 秒",
+        "total_filtered_count": len(final_results_json),
+        "filtered_data": final_results_json
+    }
+
+    # 多方面任务按方面分组返回结果
+    if len(aspects) > 1:
+        response_data["aspects"] = aspects
+        response_data["results_by_aspect"] = {
+            which_aspects: {"total_filtered_count": len(aspect_json), "filtered_data": aspect_json}
+            for which_aspects, (_, aspect_json) in results_by_aspect.items()
+        }
+    
+    # 如果有最终下载链接，添加到响应中
+    if final_download_url:
+        response_data["final_download_url"] = final_download_url
+    
+    return response_data
+
+
+def finish_job(job_id):
+    """任务结束（成功或失败）后清理检查点并释放产物引用"""
+    checkpoint_dir = get_job_checkpoint_dir(job_id)
+    for filename in ('input.xlsx', 'manifest.json'):
+        path = os.path.join(checkpoint_dir, filename)
+        if os.path.exists(path): os.remove(path)
+    if os.path.isdir(checkpoint_dir) and not os.listdir(checkpoint_dir):
+        os.rmdir(checkpoint_dir)
+    # 任务结束后释放对chunk文件和结果文件的引用，交由TTL/配额淘汰
+    release_job_artifacts(job_id)
+    with active_jobs_lock:
+        active_job_ids.discard(job_id)
+
+
+def resume_job(job_id):
+    """从检查点恢复一个被中断的任务，只调度尚未完成的chunk"""
+    start_time = time.time()
+    try:
+        manifest = load_job_manifest(job_id)
+        df_large = load_job_input(os.path.join(get_job_checkpoint_dir(job_id), 'input.xlsx'))
+        run_job(job_id, df_large, manifest, get_completed_chunk_verdicts(job_id), start_time)
+        print(f"任务 {job_id} 恢复执行完成")
+    except Exception as e:
+        if ENABLE_TRACEBACK_PRINT:
+            traceback.print_exc()
+        update_job(job_id, status='failed', error=f"恢复执行失败: {e}")
+        pop_job_backend_stats(job_id)
+    finally:
+        finish_job(job_id)
+
+
+def sweep_stale_checkpoints():
+    """
+    删除没有 running 任务对应的检查点目录，例如进程在保存上传文件后、登记任务前崩溃留下的目录。
+    job_id 在保存上传文件之前就已登记为 running，因此不会误删其他工作进程正在使用的目录。
+    """
+    running_job_ids = get_running_job_ids()
+    for job_id in os.listdir(JOB_CHECKPOINT_FOLDER):
+        checkpoint_dir = get_job_checkpoint_dir(job_id)
+        if job_id not in running_job_ids and os.path.isdir(checkpoint_dir):
+            shutil.rmtree(checkpoint_dir, ignore_errors=True)
+            print(f"已清理无主的任务检查点: {checkpoint_dir}")
+
+
+def resume_interrupted_jobs():
+    """
+    接管并在后台恢复所有被中断的任务，结果可通过 /jobs/<job_id> 查询；
+    未启用自动恢复时将被中断的任务标记为失败。最后清理无主的检查点目录。
+    """
+    with active_jobs_lock:
+        claimed, abandoned = claim_interrupted_jobs(set(active_job_ids), resume=RESUME_INTERRUPTED_JOBS)
+        active_job_ids.update(claimed + abandoned)
+    for job_id in abandoned:
+        print(f"任务 {job_id} 被中断且不再恢复，标记为失败")
+        finish_job(job_id)
+    sweep_stale_checkpoints()
+    for job_id in claimed:
+        print(f"发现被中断的任务 {job_id}，开始从检查点恢复")
+        threading.Thread(target=resume_job, args=(job_id,), daemon=True).start()
+
 
 # 5. 主API端点 (无变化)
 @app.route('/process-large-excel', methods=['POST'])
@@ -532,277 +1990,104 @@ def process_large_excel():
     file = request.files['file']
     if file.filename == '': return jsonify({"error": "没有选择文件"}), 400
     
-    # 获取which_aspects参数
-    which_aspects = request.form.get('which_aspects', '水质、水务、水利的招标信息数据')  # 默认值
-    print(f"接收到的which_aspects参数: {which_aspects}")
+    # 获取which_aspects参数，可以重复传多个，或传一个JSON数组，一个任务同时按多个方面分类
+    aspects = parse_aspects_param(default='水质、水务、水利的招标信息数据')  # 默认值
+    print(f"接收到的which_aspects参数: {aspects}")
+    if len(aspects) > MAX_ASPECTS_PER_JOB:
+        return jsonify({"error": f"which_aspects 最多 {MAX_ASPECTS_PER_JOB} 个"}), 400
+
+    # 是否启用本地预筛选、行去重、列投影、对冲请求和按方面分工作表
+    prefilter_enabled = parse_bool_param('prefilter', ENABLE_PREFILTER)
+    dedup_enabled = parse_bool_param('dedup', ENABLE_ROW_DEDUP)
+    projection_enabled = parse_bool_param('projection', ENABLE_COLUMN_PROJECTION)
+    hedging_enabled = parse_bool_param('hedging', ENABLE_HEDGING)
+    aspect_sheets_enabled = parse_bool_param('aspect_sheets', ENABLE_ASPECT_SHEETS)
     
-    if file:
-        large_excel_path = os.path.join(UPLOAD_FOLDER, f"large_{uuid.uuid4().hex[:UUID_LENGTH]}.xlsx")
+    # 客户端可以自带job_id，以便在处理过程中通过 /jobs/<job_id> 查询进度
+    job_id = request.form.get('job_id') or uuid.uuid4().hex
+    if not JOB_ID_PATTERN.match(job_id):
+        return jsonify({"error": "job_id 只能包含字母、数字、下划线和连字符，长度不超过64"}), 400
+    with active_jobs_lock:
+        if job_id in active_job_ids:
+            return jsonify({"error": "该 job_id 的任务正在执行", "job_id": job_id}), 409
+        active_job_ids.add(job_id)
+    # 再到共享状态库中原子地占用，防止其他工作进程同时执行同一 job_id
+    if not reserve_job(job_id):
+        with active_jobs_lock:
+            active_job_ids.discard(job_id)
+        return jsonify({"error": "该 job_id 的任务正在其他工作进程中执行", "job_id": job_id}), 409
+
+    start_time = time.time()
+    try:
+        # 输入文件保存在任务检查点目录中，进程中断后可据此恢复
+        checkpoint_dir = get_job_checkpoint_dir(job_id)
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        large_excel_path = os.path.join(checkpoint_dir, 'input.xlsx')
         file.save(large_excel_path)
-        start_time = time.time()
 
-        try:
-            df_large = pd.read_excel(large_excel_path)
-            # 真正新增一列自增 id，而不是用旧索引
-            df_large.insert(0, ID_COLUMN_NAME, range(len(df_large)))
-            print(f"成功加载Excel并自动添加了 '{ID_COLUMN_NAME}' 列。总行数: {len(df_large)}")
-            chunk_size = DEFAULT_CHUNK_SIZE  # 从配置读取
-            print(f"使用chunk大小: {chunk_size} 行")
-            # 创建chunk列表 - 切分后自行并发调用，无需按顺序
-            df_chunks = [(i // chunk_size, df_large.iloc[i:i + chunk_size]) for i in range(0, len(df_large), chunk_size)]
-            total_chunks = len(df_chunks)
-            
-            # 存储所有结果的线程安全容器
-            import threading
-            results_lock = threading.Lock()
-            all_filtered_ids = []
-            download_urls = []
-            final_results_df = pd.DataFrame()
-            final_results_json = []
-            retry_count = 0
-            
-            # 跟踪chunk处理状态
-            chunk_status = {}
-            for chunk_id, _ in df_chunks:
-                chunk_status[chunk_id] = {'status': 'pending', 'retries': 0}
-
-            def process_chunk_concurrent(chunk_id, chunk_df, which_aspects_value):
-                """并发处理单个chunk，支持无限重试直到成功"""
-                retry = 0
-                while True:  # 无限循环直到成功
-                    try:
-                        result = call_small_workflow(chunk_id, chunk_df, which_aspects_value)
-                        if result['status'] == 'SUCCESS':
-                            # 线程安全地处理结果
-                            with results_lock:
-                                chunk_status[chunk_id]['status'] = 'success'  # 标记为成功状态
-                                if result.get('download_url'):
-                                    download_urls.append(result['download_url'])
-                                    # 实时处理结果数据
-                                    try:
-                                        file_response = requests.get(result['download_url'], timeout=FILE_DOWNLOAD_TIMEOUT)
-                                        file_response.raise_for_status()
-                                        df_chunk_result = pd.read_excel(io.BytesIO(file_response.content))
-                                        
-                                        if 'id' in df_chunk_result.columns:
-                                            chunk_ids = df_chunk_result['id'].tolist()
-                                            
-                                            # 过滤掉已经处理过的ID，避免重复
-                                            new_chunk_ids = [cid for cid in chunk_ids if cid not in all_filtered_ids]
-                                            all_filtered_ids.extend(new_chunk_ids)
-                                            
-                                            if new_chunk_ids:  # 只处理新的ID
-                                                # 使用小 Dify 返回的 id 从 df_large 中提取完整行
-                                                matched_rows = df_large[df_large[ID_COLUMN_NAME].isin(new_chunk_ids)].copy()
-                                                
-                                                # 移除 ID 列
-                                                matched_rows = matched_rows.drop(columns=[ID_COLUMN_NAME], errors='ignore')
-                                                
-                                                # 假设关键词列名为 '关键词'，将其移到第一列（如果存在）
-                                                if '关键词' in matched_rows.columns:
-                                                    columns = ['关键词'] + [col for col in matched_rows.columns if col != '关键词']
-                                                    matched_rows = matched_rows[columns]
-                                                
-                                                # 合并到最终 DataFrame
-                                                final_results_df = pd.concat([final_results_df, matched_rows], ignore_index=True)
-                                                
-                                                # 将每行数据转换为字典并添加到结果列表
-                                                for _, row in matched_rows.iterrows():
-                                                    row_dict = row.to_dict()
-                                                    # 删除可能的剩余 ID 列
-                                                    for col in COLUMNS_TO_REMOVE:
-                                                        if col in row_dict:
-                                                            del row_dict[col]
-                                                    final_results_json.append(row_dict)
-                                    except Exception:
-                                        pass
-                            return {'status': 'SUCCESS', 'chunk_id': chunk_id, 'download_url': result.get('download_url', '')}
-                        else:
-                            # 失败重试
-                            retry += 1
-                            with results_lock:
-                                chunk_status[chunk_id]['retries'] += 1
-                            print(f"Chunk #{chunk_id} 第{retry}次重试...")
-                            time.sleep(RETRY_DELAY)
-                    except Exception as e:
-                        # 异常重试
-                        retry += 1
-                        with results_lock:
-                            chunk_status[chunk_id]['retries'] += 1
-                        print(f"Chunk #{chunk_id} 第{retry}次重试，异常: {str(e)[:100]}...")
-                        time.sleep(RETRY_DELAY)
-
-            # 并发处理所有chunk - 完全随机并发，不限制顺序
-            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-                # 一次性提交所有任务，让线程池自由调度
-                future_to_chunk = {
-                    executor.submit(process_chunk_concurrent, chunk_id, chunk_df, which_aspects): chunk_id 
-                    for chunk_id, chunk_df in df_chunks
-                }
-                
-                # 实时处理完成的任务（无需等待批次）
-                for future in as_completed(future_to_chunk):
-                    result = future.result()
-                    if result and result.get('status') == 'FAILED':
-                        chunk_id = result.get('chunk_id', '未知')
-                        print(f"Chunk {chunk_id} 处理失败: {result.get('error', '未知错误')}")
-                    elif result and result.get('status') == 'SUCCESS':
-                        chunk_id = result.get('chunk_id', '未知')
-                        print(f"Chunk {chunk_id} 处理成功")
-                        
-            # 显示最终处理统计
-            successful_chunks = len([cid for cid, status in chunk_status.items() if status['status'] == 'success'])
-            total_retries = sum([status['retries'] for status in chunk_status.values()])
-            print(f"处理完成 - 总chunk数: {total_chunks}, 成功: {successful_chunks}")
-            
-            # 如果没有实时汇总数据，使用备用处理方式
-            if len(final_results_json) == 0:
-                print("使用备用处理方式：下载所有chunk结果文件并重新处理")
-                
-                # 用于去重的ID集合
-                processed_ids = set()
-                
-                # 下载所有成功的chunk结果文件
-                for download_url in download_urls:
-                    try:
-                        # 下载文件
-                        file_response = requests.get(download_url, timeout=FILE_DOWNLOAD_TIMEOUT)
-                        file_response.raise_for_status()
-                        
-                        # 读取Excel数据
-                        df_chunk_result = pd.read_excel(io.BytesIO(file_response.content))
-                        
-                        if not df_chunk_result.empty and 'id' in df_chunk_result.columns:
-                            # 获取小Dify返回的ID列表
-                            chunk_ids = df_chunk_result['id'].tolist()
-                            
-                            # 过滤掉已经处理过的ID，避免重复
-                            new_chunk_ids = [cid for cid in chunk_ids if cid not in processed_ids]
-                            processed_ids.update(new_chunk_ids)
-                            
-                            if new_chunk_ids:  # 只处理新的ID
-                                # 使用ID从原始数据中提取完整行（保持原始数据完整性）
-                                matched_rows = df_large[df_large[ID_COLUMN_NAME].isin(new_chunk_ids)].copy()
-                                
-                                # 移除ID列
-                                matched_rows = matched_rows.drop(columns=[ID_COLUMN_NAME], errors='ignore')
-                                
-                                # 将关键词列移到第一列（如果存在）
-                                if '关键词' in matched_rows.columns:
-                                    columns = ['关键词'] + [col for col in matched_rows.columns if col != '关键词']
-                                    matched_rows = matched_rows[columns]
-                                
-                                # 合并到最终DataFrame
-                                final_results_df = pd.concat([final_results_df, matched_rows], ignore_index=True)
-                                
-                                # 转换为JSON格式
-                                for _, row in matched_rows.iterrows():
-                                    row_dict = row.to_dict()
-                                    # 删除可能的剩余ID列
-                                    for col in COLUMNS_TO_REMOVE:
-                                        if col in row_dict:
-                                            del row_dict[col]
-                                    final_results_json.append(row_dict)
-                                
-                    except Exception as e:
-                        print(f"处理下载文件失败: {str(e)}")
-                        continue
-                    
+        df_large = load_job_input(large_excel_path)
+        manifest = plan_job(job_id, df_large, aspects, prefilter_enabled, dedup_enabled,
+                            projection_enabled, hedging_enabled, aspect_sheets_enabled)
+        save_job_manifest(job_id, manifest)
+        register_job(job_id, aspects, [(chunk_id, aspect_index) for aspect_index, chunk_ids in enumerate(manifest['aspect_chunks'])
+                                       for chunk_id in chunk_ids])
 
-            
-            # 在保存最终结果文件之前进行排序和去重
-            if not final_results_df.empty:
-                # 先去重 - 基于所有列的组合去重
-                print(f"去重前记录数: {len(final_results_df)}")
-                final_results_df = final_results_df.drop_duplicates()
-                print(f"去重后记录数: {len(final_results_df)}")
-                
-                # 确保关键词和时间列存在
-                if '关键词' in final_results_df.columns and '时间' in final_results_df.columns:
-                    print("正在对最终结果进行排序：先按关键词，再按时间...")
-                    # 先按关键词排序，同类别内再按时间排序
-                    final_results_df = final_results_df.sort_values(['关键词', '时间'], ascending=[True, True])
-                    print(f"排序完成，共 {len(final_results_df)} 条记录")
-                else:
-                    print("警告：未找到关键词或时间列，跳过排序")
-                    
-                # 重新构建final_results_json以确保与DataFrame一致
-                final_results_json = []
-                for _, row in final_results_df.iterrows():
-                    row_dict = row.to_dict()
-                    # 删除可能的剩余ID列
-                    for col in COLUMNS_TO_REMOVE:
-                        if col in row_dict:
-                            del row_dict[col]
-                    final_results_json.append(row_dict)
-            
-            # 保存最终结果文件
-            final_filename = f"final_result_{uuid.uuid4().hex[:UUID_LENGTH]}.xlsx"
-            final_filepath = os.path.join(DOWNLOAD_FOLDER, final_filename)
-            
-            # 使用最终处理的数据
-            final_df_to_save = final_results_df
-            
-            # 保存文件 - 确保移除所有可能的ID列和索引列
-            # 检查并删除所有可能的ID列
-            for col in COLUMNS_TO_REMOVE:
-                if col in final_df_to_save.columns:
-                    final_df_to_save = final_df_to_save.drop(columns=[col])
-            
-            # 检查是否有数字索引列（通常是第一列）
-            if len(final_df_to_save.columns) > 0:
-                first_col = final_df_to_save.columns[0]
-                # 如果第一列是数字且不是预期的关键词列，则删除它
-                if first_col.isdigit() or first_col in ['index', 'Unnamed: 0']:
-                    final_df_to_save = final_df_to_save.drop(columns=[first_col])
-            
-            # 确保不保存索引作为列
-            final_df_to_save.to_excel(final_filepath, index=False)
-            
-            # 上传文件到文件服务器
-            try:
-                with open(final_filepath, 'rb') as f:
-                    files = {'file': (final_filename, f, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')}
-                    upload_response = requests.post(f"http://{FILE_SERVER_HOST}:{FILE_SERVER_PORT}/upload", files=files)
-                    upload_response.raise_for_status()
-                    final_download_url = upload_response.json().get('download_url', '')
-            except Exception as e:
-                final_download_url = f"http://{FILE_SERVER_HOST}:{FILE_SERVER_PORT}/downloads/{final_filename}"
-            
-            end_time = time.time()
-            
-            # 构建返回结果
-            successful_chunks = len([cid for cid, status in chunk_status.items() if status['status'] == 'success'])
-            response_data = {
-                "message": "处理完成",
-                "summary": { 
-                    "total_chunks": total_chunks, 
-                    "successful_chunks": successful_chunks,
-                    "chunk_size": chunk_size,
-                    "retry_mode": "infinite_retries"  # 标识使用无限重试模式
-                },
-                "processing_time": f"{end_time - start_time:.2f} 秒",
-                "total_filtered_count": len(final_results_json),
-                "filtered_data": final_results_json
-            }
-            
-            # 如果有最终下载链接，添加到响应中
-            if final_download_url:
-                response_data["final_download_url"] = final_download_url
-            
-            return jsonify(response_data)
+        response_data = run_job(job_id, df_large, manifest, {}, start_time)
+        return jsonify(response_data)
 
-        except Exception as e:
-            if ENABLE_TRACEBACK_PRINT:
-                traceback.print_exc()
-            return jsonify({"error": "服务器内部错误", "details": str(e), "trace": traceback.format_exc() if ENABLE_TRACEBACK_PRINT else None}), 500
-        finally:
-            if os.path.exists(large_excel_path): os.remove(large_excel_path)
+    except Exception as e:
+        if ENABLE_TRACEBACK_PRINT:
+            traceback.print_exc()
+        update_job(job_id, status='failed', error=str(e))
+        pop_job_backend_stats(job_id)
+        return jsonify({"error": "服务器内部错误", "details": str(e), "trace": traceback.format_exc() if ENABLE_TRACEBACK_PRINT else None}), 500
+    finally:
+        finish_job(job_id)
+
+
+def run_production_server():
+    """
+    使用 gunicorn 以多进程方式运行（需要 pip install gunicorn）。
+    任务状态和产物索引都在共享状态库中，任意工作进程都能提供chunk文件下载和任务状态查询。
+    """
+    from gunicorn.app.base import BaseApplication
+
+    class ProductionApplication(BaseApplication):
+        def __init__(self, application, options):
+            self.application = application
+            self.options = options
+            super().__init__()
 
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
 
-    return jsonify({"error": "文件处理失败"}), 500
+        def load(self):
+            return self.application
+
+    options = {
+        'bind': f"{FLASK_HOST}:{FLASK_PORT}",
+        'workers': PRODUCTION_WORKERS,
+        'worker_class': 'gthread',
+        'threads': PRODUCTION_THREADS,
+        'timeout': PRODUCTION_TIMEOUT,
+        # 每个工作进程启动后尝试接管被中断的任务（同一任务只会被一个进程接管）
+        'post_worker_init': lambda worker: resume_interrupted_jobs(),
+    }
+    print(f"以生产模式启动: {PRODUCTION_WORKERS} 个进程 x {PRODUCTION_THREADS} 个线程")
+    print(f"Dify后端并发上限按进程计算，每个后端实际最多 max_concurrency x {PRODUCTION_WORKERS} 个在途请求")
+    ProductionApplication(app, options).run()
 
 
 # 5. 启动Web服务
+# 开发模式: python back_all.py
+# 生产模式: RUN_MODE=production python back_all.py，或 gunicorn -c gunicorn.conf.py -w 4 -k gthread --threads 8 -t 3600 back_all:app
+#          直接用 gunicorn 启动时必须带上 -c gunicorn.conf.py，否则工作进程不会恢复被中断的任务
 if __name__ == '__main__':
-    app.run(host=FLASK_HOST, port=FLASK_PORT, debug=FLASK_DEBUG)
\ No newline at end of file
+    if RUN_MODE == 'production':
+        run_production_server()
+    else:
+        # 调试模式下 reloader 的监控进程不处理请求，只在实际服务的子进程中恢复任务
+        if not FLASK_DEBUG or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            resume_interrupted_jobs()
+        app.run(host=FLASK_HOST, port=FLASK_PORT, debug=FLASK_DEBUG)
\ No newline at end of file
@@ -2,7 +2,13 @@
 
 import os
 import uuid # 用于生成唯一的文件名，防止文件被覆盖
+import csv
+import json
+import codecs
+import tempfile
+import threading
 from flask import Flask, request, jsonify, send_from_directory
+from openpyxl import Workbook
 import pandas as pd
 
 # 1. 初始化 Flask 应用
@@ -14,19 +20,317 @@ DOWNLOAD_FOLDER = os.path.join('static', 'downloads')
 if not os.path.exists(DOWNLOAD_FOLDER):
     os.makedirs(DOWNLOAD_FOLDER)
 
+#    流式模式配置：请求体超过阈值（或带 ?mode=stream）时边解析边落盘，文件在后台生成
+STREAMING_THRESHOLD_BYTES = 1024 * 1024   # 超过该大小的请求自动使用流式模式
+STREAM_READ_SIZE = 64 * 1024              # 每次从请求体读取的字节数
+FINALIZE_WAIT_TIMEOUT = 120               # 下载时等待后台生成文件的最长时间（秒）
+DEFAULT_SHEET_NAME = 'Sheet1'             # 只传 data 时使用的工作表名
+FAILED_FILES_MAX_ENTRIES = 1000           # 最多保留多少条生成失败记录
+
+# 正在后台生成的文件: 文件名 -> threading.Event（生成结束时 set）
+pending_files = {}
+pending_files_lock = threading.Lock()
+# 后台生成失败的文件: 文件名 -> 错误信息（下载时返回 500，而不是 404）
+failed_files = {}
+
+
+class StreamingJsonReader:
+    """
+    从文件流中增量解析JSON，只缓冲当前正在解析的那个值，
+    用于逐条读取很大的 data 数组而不把整个请求体读进内存。
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json_decoder = json.JSONDecoder()
+
+    def _fill(self):
+        """读入更多数据，丢弃已解析部分；已到结尾时返回 False"""
+        if self.eof:
+            return False
+        data = self.stream.read(STREAM_READ_SIZE)
+        if not data:
+            self.eof = True
+            self.buffer = self.buffer[self.pos:] + self.text_decoder.decode(b'', final=True)
+            self.pos = 0
+            return False
+        self.buffer = self.buffer[self.pos:] + self.text_decoder.decode(data)
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """跳过空白并返回下一个字符，到结尾时返回空字符串"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"JSON格式错误: 期望 '{char}'")
+        self.pos += 1
+
+    def read_value(self):
+        """读取一个完整的JSON值（对象、数组、字符串、数字等）"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buffer, self.pos)
+                # 数字可能被截断在缓冲区末尾，后面还有字符或已到结尾才算完整
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def iter_array(self):
+        """逐个返回数组元素"""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.read_value()
+            char = self.peek()
+            self.pos += 1
+            if char == ']':
+                return
+            if char != ',':
+                raise ValueError("JSON格式错误: 数组元素之间缺少 ','")
+
+    def iter_object_keys(self):
+        """逐个返回对象的键，调用方必须在取下一个键之前读掉对应的值"""
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            if not isinstance(key, str):
+                raise ValueError("JSON格式错误: 对象的键必须是字符串")
+            self.expect(':')
+            yield key
+            char = self.peek()
+            self.pos += 1
+            if char == '}':
+                return
+            if char != ',':
+                raise ValueError("JSON格式错误: 对象成员之间缺少 ','")
+
+
+def iter_sheet_rows(reader):
+    """
+    按 (工作表名, 行) 逐条产出请求中的数据，支持两种格式:
+      {"data": [{...}, ...]}                       -> 单个工作表
+      {"sheets": {"工作表A": [{...}], "工作表B": [...]}} -> 多个命名工作表
+    """
+    for key in reader.iter_object_keys():
+        if key == 'data':
+            for row in reader.iter_array():
+                yield DEFAULT_SHEET_NAME, row
+        elif key == 'sheets':
+            for sheet_name in reader.iter_object_keys():
+                for row in reader.iter_array():
+                    yield sheet_name, row
+        else:
+            reader.read_value()  # 其他字段直接跳过
+
+
+def safe_sheet_name(name, used_names):
+    """Excel 工作表名最长31个字符，且不能包含 []:*?/\\"""
+    cleaned = ''.join('_' if char in '[]:*?/\\' else char for char in str(name)).strip() or DEFAULT_SHEET_NAME
+    cleaned = cleaned[:31]
+    candidate, index = cleaned, 1
+    while candidate in used_names:
+        suffix = f"_{index}"
+        candidate = cleaned[:31 - len(suffix)] + suffix
+        index += 1
+    used_names.add(candidate)
+    return candidate
+
+
+def to_cell_value(value):
+    """嵌套的对象/数组转成JSON字符串写入单元格"""
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+def spool_sheets(stream):
+    """
+    边解析边把每行写入磁盘上的临时 jsonl 文件，内存中只保留列名和行数。
+    返回 {工作表名: {'path', 'columns', 'rows'}}，按出现顺序排列。
+    """
+    sheets = {}
+    try:
+        for sheet_name, row in iter_sheet_rows(StreamingJsonReader(stream)):
+            if not isinstance(row, dict):
+                raise ValueError("data 中的每一项都必须是JSON对象")
+            sheet = sheets.get(sheet_name)
+            if sheet is None:
+                spool = tempfile.NamedTemporaryFile('w', encoding='utf-8', suffix='.jsonl', delete=False)
+                sheet = sheets[sheet_name] = {'file': spool, 'path': spool.name, 'columns': {}, 'rows': 0}
+            for column in row:
+                sheet['columns'].setdefault(column, None)  # dict 保持列的首次出现顺序
+            sheet['file'].write(json.dumps(row, ensure_ascii=False) + '\n')
+            sheet['rows'] += 1
+    except Exception:
+        discard_spools(sheets)
+        raise
+    for sheet in sheets.values():
+        sheet['file'].close()
+        sheet['columns'] = list(sheet['columns'])
+    return sheets
+
+
+def iter_spooled_rows(sheet):
+    with open(sheet['path'], encoding='utf-8') as f:
+        for line in f:
+            row = json.loads(line)
+            yield [to_cell_value(row.get(column)) for column in sheet['columns']]
+
+
+def discard_spools(sheets):
+    for sheet in sheets.values():
+        if not sheet['file'].closed:
+            sheet['file'].close()
+        if os.path.exists(sheet['path']):
+            os.remove(sheet['path'])
+
+
+def finalize_files(targets, sheets, output_format):
+    """
+    后台线程: 把临时文件写成最终文件（xlsx 用 write-only 模式逐行写入）。
+    先写临时文件再改名，下载方不会读到写了一半的文件。
+    targets 为 [(文件名, [工作表名, ...]), ...]
+    """
+    finished = set()
+    tmp_path = None
+    try:
+        for filename, sheet_names in targets:
+            file_path = os.path.join(DOWNLOAD_FOLDER, filename)
+            tmp_path = os.path.join(DOWNLOAD_FOLDER, f".tmp_{filename}")
+            if output_format == 'csv':
+                sheet = sheets[sheet_names[0]]
+                # utf-8-sig 让 Excel 正确识别中文
+                with open(tmp_path, 'w', encoding='utf-8-sig', newline='') as f:
+                    writer = csv.writer(f)
+                    writer.writerow(sheet['columns'])
+                    writer.writerows(iter_spooled_rows(sheet))
+            else:
+                workbook = Workbook(write_only=True)
+                used_names = set()
+                for sheet_name in sheet_names:
+                    sheet = sheets[sheet_name]
+                    worksheet = workbook.create_sheet(safe_sheet_name(sheet_name, used_names))
+                    worksheet.append(sheet['columns'])
+                    for values in iter_spooled_rows(sheet):
+                        worksheet.append(values)
+                workbook.save(tmp_path)
+            os.replace(tmp_path, file_path)
+            finished.add(filename)
+    except Exception as e:
+        print(f"后台生成文件时发生错误: {e}")
+        # 删除写了一半的临时文件，并记录失败原因，未生成的文件下载时返回错误信息
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        with pending_files_lock:
+            for filename, _ in targets:
+                if filename not in finished:
+                    failed_files[filename] = str(e)
+            while len(failed_files) > FAILED_FILES_MAX_ENTRIES:
+                failed_files.pop(next(iter(failed_files)))
+    finally:
+        discard_spools(sheets)
+        for filename, _ in targets:
+            with pending_files_lock:
+                event = pending_files.pop(filename, None)
+            if event is not None:
+                event.set()
+
+
+def generate_excel_streaming():
+    """
+    流式模式: 增量解析请求体并落盘，随即返回下载链接，最终文件在后台线程中生成。
+    ?format=csv 时每个工作表生成一个CSV文件。
+    """
+    output_format = request.args.get('format', 'xlsx').lower()
+    if output_format not in ('xlsx', 'csv'):
+        return jsonify({"error": "format 只支持 xlsx 或 csv"}), 400
+
+    try:
+        sheets = spool_sheets(request.stream)
+    except ValueError as e:
+        return jsonify({"error": f"JSON数据格式不正确: {e}"}), 400
+
+    if not sheets:
+        return jsonify({"error": "JSON数据格式不正确或列表为空"}), 400
+
+    file_id = uuid.uuid4().hex[:8]
+    if output_format == 'csv':
+        targets = [(f"output_{file_id}_{index}.csv", [sheet_name]) for index, sheet_name in enumerate(sheets)]
+    else:
+        targets = [(f"output_{file_id}.xlsx", list(sheets))]
+
+    with pending_files_lock:
+        for filename, _ in targets:
+            pending_files[filename] = threading.Event()
+    threading.Thread(target=finalize_files, args=(targets, sheets, output_format), daemon=True).start()
+
+    server_url = request.host_url
+    response_data = {
+        "download_url": f"{server_url}downloads/{targets[0][0]}",
+        "rows": {sheet_name: sheet['rows'] for sheet_name, sheet in sheets.items()},
+        "status": "processing"  # 文件在后台生成，下载时会等待生成完成
+    }
+    if output_format == 'csv':
+        # 每个工作表一个CSV文件
+        response_data["download_urls"] = {sheet_names[0]: f"{server_url}downloads/{filename}" for filename, sheet_names in targets}
+    return jsonify(response_data)
+
+
+def should_stream():
+    if request.args.get('mode') == 'stream':
+        return True
+    return (request.content_length or 0) > STREAMING_THRESHOLD_BYTES
+
+
 # 3. 创建核心API端点，Dify将向这里发送POST请求
 @app.route('/generate-excel', methods=['POST'])
 def generate_excel():
     """
     接收JSON数据，生成Excel文件，并返回下载链接。
+    大请求（或 ?mode=stream）走流式模式，见 generate_excel_streaming。
     """
     try:
+        if should_stream():
+            return generate_excel_streaming()
+
         # a. 从POST请求中获取JSON数据
         payload = request.get_json()
         if not payload:
             return jsonify({"error": "请求中没有找到JSON数据"}), 400
 
-        # b. 从JSON中提取我们关心的数据列表 (键名为'data')
+        # b. 多个命名工作表 {"sheets": {"名称": [...]}} 写入同一个Excel文件
+        sheets_data = payload.get('sheets')
+        if isinstance(sheets_data, dict) and sheets_data:
+            unique_filename = f"output_{uuid.uuid4().hex[:8]}.xlsx"
+            used_names = set()
+            with pd.ExcelWriter(os.path.join(DOWNLOAD_FOLDER, unique_filename)) as writer:
+                for sheet_name, rows in sheets_data.items():
+                    pd.DataFrame(rows).to_excel(writer, sheet_name=safe_sheet_name(sheet_name, used_names), index=False)
+            return jsonify({"download_url": f"{request.host_url}downloads/{unique_filename}"})
+
+        # 从JSON中提取我们关心的数据列表 (键名为'data')
         data_list = payload.get('data')
         if not isinstance(data_list, list) or not data_list:
             return jsonify({"error": "JSON数据格式不正确或列表为空"}), 400
@@ -48,7 +352,7 @@ def generate_excel():
         #    例如: http://123.45.67.89:5001/downloads/output_a1b2c3d4.xlsx
         server_url = request.host_url
         download_url = f"{server_url}downloads/{unique_filename}"
-        
+
         # g. 返回包含下载链接的JSON响应
         return jsonify({"download_url": download_url})
 
@@ -63,7 +367,16 @@ def generate_excel():
 def download_file(filename):
     """
     从DOWNLOAD_FOLDER目录中提供静态文件下载。
+    流式模式下文件可能仍在后台生成，这里最多等待 FINALIZE_WAIT_TIMEOUT 秒；后台生成失败时返回 500 和错误信息。
     """
+    with pending_files_lock:
+        event = pending_files.get(filename)
+    if event is not None and not event.wait(FINALIZE_WAIT_TIMEOUT):
+        return jsonify({"error": "文件仍在生成中，请稍后重试"}), 503, {'Retry-After': '5'}
+    with pending_files_lock:
+        error = failed_files.get(filename)
+    if error is not None:
+        return jsonify({"error": "文件生成失败", "details": error}), 500
     return send_from_directory(DOWNLOAD_FOLDER, filename, as_attachment=True)
 
 
@@ -1,43 +1,49 @@
 #!/bin/bash
 
-# 清空static和temp文件夹的脚本
+# 清理遗留的任务检查点目录和旧版本temp文件夹的脚本
 # 作者: 系统管理员
 # 创建时间: $(date)
+#
+# 注意: static/downloads 下的chunk文件和最终结果文件由 back_all.py 内置的产物存储
+# 按 TTL / 磁盘配额自动淘汰（不会删除仍被任务引用的文件），这里不再清空static文件夹。
+# state/jobs 下无主的检查点目录在服务启动时会按共享状态库精确清理，这里只按时间兜底清理长期未动的目录。
 
-# 设置脚本目录
-SCRIPT_DIR="/root/QLM-Tender/FrontBack"
-STATIC_DIR="$SCRIPT_DIR/static"
+# 设置脚本目录（脚本所在目录，即 back_all.py 的工作目录）
+SCRIPT_DIR="$(cd "$(dirname "$0")" && pwd)"
 TEMP_DIR="$SCRIPT_DIR/temp"
+CHECKPOINT_DIR="$SCRIPT_DIR/state/jobs"
+
+# 只清理超过该分钟数未修改的文件
+TEMP_MAX_AGE_MINUTES=1440
+# 检查点目录超过该分钟数未修改才清理，需远大于单个任务的最长执行时间
+CHECKPOINT_MAX_AGE_MINUTES=10080
 
 # 日志文件
 LOG_FILE="$SCRIPT_DIR/cleanup.log"
 
 # 记录开始时间
-echo "$(date '+%Y-%m-%d %H:%M:%S') - 开始清空文件夹" >> "$LOG_FILE"
-
-# 清空static文件夹
-if [ -d "$STATIC_DIR" ]; then
-    echo "$(date '+%Y-%m-%d %H:%M:%S') - 清空static文件夹: $STATIC_DIR" >> "$LOG_FILE"
-    find "$STATIC_DIR" -type f -delete 2>/dev/null
-    find "$STATIC_DIR" -type d -empty -delete 2>/dev/null
-    echo "$(date '+%Y-%m-%d %H:%M:%S') - static文件夹清空完成" >> "$LOG_FILE"
-else
-    echo "$(date '+%Y-%m-%d %H:%M:%S') - static文件夹不存在: $STATIC_DIR" >> "$LOG_FILE"
+echo "$(date '+%Y-%m-%d %H:%M:%S') - 开始清理文件夹" >> "$LOG_FILE"
+
+# 清理长期未动的任务检查点目录（进程崩溃后未恢复的任务留下的 input.xlsx / manifest.json）
+if [ -d "$CHECKPOINT_DIR" ]; then
+    echo "$(date '+%Y-%m-%d %H:%M:%S') - 清理任务检查点: $CHECKPOINT_DIR (超过 ${CHECKPOINT_MAX_AGE_MINUTES} 分钟未修改的目录)" >> "$LOG_FILE"
+    find "$CHECKPOINT_DIR" -mindepth 1 -maxdepth 1 -type d -mmin +"$CHECKPOINT_MAX_AGE_MINUTES" -exec rm -rf {} + 2>/dev/null
+    echo "$(date '+%Y-%m-%d %H:%M:%S') - 任务检查点清理完成" >> "$LOG_FILE"
 fi
 
-# 清空temp文件夹
+# 清理旧版本遗留的temp文件夹（当前版本已不再写入temp）
 if [ -d "$TEMP_DIR" ]; then
-    echo "$(date '+%Y-%m-%d %H:%M:%S') - 清空temp文件夹: $TEMP_DIR" >> "$LOG_FILE"
-    find "$TEMP_DIR" -type f -delete 2>/dev/null
-    find "$TEMP_DIR" -type d -empty -delete 2>/dev/null
-    echo "$(date '+%Y-%m-%d %H:%M:%S') - temp文件夹清空完成" >> "$LOG_FILE"
+    echo "$(date '+%Y-%m-%d %H:%M:%S') - 清理temp文件夹: $TEMP_DIR (超过 ${TEMP_MAX_AGE_MINUTES} 分钟的文件)" >> "$LOG_FILE"
+    find "$TEMP_DIR" -type f -mmin +"$TEMP_MAX_AGE_MINUTES" -delete 2>/dev/null
+    find "$TEMP_DIR" -mindepth 1 -type d -empty -delete 2>/dev/null
+    echo "$(date '+%Y-%m-%d %H:%M:%S') - temp文件夹清理完成" >> "$LOG_FILE"
 else
     echo "$(date '+%Y-%m-%d %H:%M:%S') - temp文件夹不存在: $TEMP_DIR" >> "$LOG_FILE"
 fi
 
 # 记录结束时间
-echo "$(date '+%Y-%m-%d %H:%M:%S') - 文件夹清空任务完成" >> "$LOG_FILE"
+echo "$(date '+%Y-%m-%d %H:%M:%S') - 文件夹清理任务完成" >> "$LOG_FILE"
 echo "----------------------------------------" >> "$LOG_FILE"
 
 # 输出到控制台（可选）
-echo "文件夹清空任务完成 - $(date '+%Y-%m-%d %H:%M:%S')"
\ No newline at end of file
+echo "文件夹清理任务完成 - $(date '+%Y-%m-%d %H:%M:%S')"
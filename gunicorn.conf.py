@@ -0,0 +1,8 @@
+# gunicorn 配置：直接用 gunicorn 启动 back_all:app 时使用
+# gunicorn -c gunicorn.conf.py -w 4 -k gthread --threads 8 -t 3600 back_all:app
+
+
+def post_worker_init(worker):
+    # 每个工作进程启动后尝试接管被中断的任务（同一任务只会被一个进程接管）
+    from back_all import resume_interrupted_jobs
+    resume_interrupted_jobs()